@@ -1,11 +1,22 @@
 import os
+import errno
+import bisect
+import itertools
 import logging
 import threading
+import signal
 import dbus, dbus.service
-import importlib
 import time
+import json
+from collections import OrderedDict
 
 from . import config as configmgr # Must be imported after GTK
+from .account import account_module
+from .scheduler import Scheduler
+from .statecache import StateCache
+from . import connectivity
+from . import metrics
+from . import recorder
 
 # FIXME
 DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
@@ -16,11 +27,20 @@ os.chdir(DATA_DIR)
 DBUS_NAME = 'nandhp.multiowl'
 DBUS_PATH = '/nandhp/multiowl'
 class DBusService(dbus.service.Object):
+    RATE = 1000     # Milliseconds between CountsChanged signals, at least
+
     def __init__(self, app):
         name = dbus.service.BusName(DBUS_NAME, bus=dbus.SessionBus())
         dbus.service.Object.__init__(self, name, DBUS_PATH)
         self.app = app
 
+        # Accounts whose count changed since the last CountsChanged signal
+        self._lock = threading.Lock()
+        self._changed = set()
+        self._pending = False
+        self._last_signal = 0
+        self._signalled = {}    # Account name -> count last signalled
+
     @dbus.service.method(dbus_interface=DBUS_NAME)
     def test(self):
         print "Alerted!"
@@ -29,12 +49,78 @@ class DBusService(dbus.service.Object):
     def preferences(self):
         self.app.configurator.show()
 
+    @dbus.service.method(dbus_interface=DBUS_NAME, out_signature='s')
+    def GetMetrics(self):
+        # Per-account latencies, traffic and errors, and process totals, as
+        # a JSON document
+        return json.dumps(metrics.snapshot(self.app))
+
+    @dbus.service.method(dbus_interface=DBUS_NAME, out_signature='s')
+    def GetSchedule(self):
+        # When each account was and will next be checked, its backoff and
+        # adapted interval, and the connections being set up, as a JSON
+        # document
+        return json.dumps(self.app.scheduler.snapshot())
+
+    @dbus.service.method(dbus_interface=DBUS_NAME, out_signature='s')
+    def GetFlightRecord(self):
+        # Each account's recent protocol events, as a JSON document
+        return json.dumps(recorder.snapshot(self.app))
+
+    def _counts(self, names):
+        # Unknown counts, e.g. after an error, are given as -1, as are those
+        # of accounts that have been removed
+        counts = {}
+        for name in names:
+            account = self.app.accounts.get(name)
+            count = account.count if account else None
+            counts[name] = count if type(count) is int else -1
+        return counts
+
+    @dbus.service.method(dbus_interface=DBUS_NAME, out_signature='a{si}')
+    def GetCounts(self):
+        # The unread count of every account
+        return self._counts(self.app.accountnames)
+
+    @dbus.service.signal(dbus_interface=DBUS_NAME, signature='a{si}')
+    def CountsChanged(self, counts):
+        # The new counts of the accounts whose count changed
+        pass
+
+    def count_changed(self, account):
+        # May be called from any thread; a burst of changes results in a
+        # single signal, sent no sooner than RATE after the last one
+        with self._lock:
+            self._changed.add(account.name)
+            if self._pending:
+                return
+            self._pending = True
+            delay = self._last_signal + self.RATE / 1000. - time.time()
+        self.app.ui.call_later(max(int(delay * 1000), 0), self._signal)
+
+    def _signal(self):
+        assert threading.current_thread() == MAIN_THREAD
+        with self._lock:
+            changed = self._changed
+            self._changed = set()
+            self._pending = False
+            self._last_signal = time.time()
+        counts = dict((name, count) for name, count
+                      in self._counts(changed).items()
+                      if self._signalled.get(name) != count)
+        self._signalled.update(counts)
+        if counts:
+            self.CountsChanged(counts)
+
 MAIN_THREAD = threading.current_thread()
 
 class AccountIconDataBase(object):
     def __init__(self, account, config):
         self.active = False
         self.count = None
+        # This account's share of the icon's tooltip and message total
+        self.tooltip = []
+        self.messages = 0
         self.updated(0)
 
     def updated(self, strike):
@@ -42,6 +128,7 @@ class AccountIconDataBase(object):
 
 class MailIconBase(object):
     INTERVAL = 3000
+    FRAME = 50      # Notifications are coalesced into one update per frame
 
     def __init__(self, app):
         self.log = logging.getLogger('icon')
@@ -49,6 +136,21 @@ class MailIconBase(object):
         self.displaying = None
         self.base = None
         self._account_data_class = AccountIconDataBase
+
+        # Accounts changed since the last update; None means all of them
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._update_pending = False
+        self._total = 0
+        self._active = 0
+        self._cycling = False
+        # Where each of the icon's accounts is in the app's order, those
+        # with a share of the tooltip as sorted (position, name), and their
+        # shares in the same order
+        self._positions = {}
+        self._shown = []
+        self._fragments = []
+
         self.check_obsolete_timer(180*1000)
 
     def refresh_tooltip(self, heading, accounts):
@@ -66,9 +168,19 @@ class MailIconBase(object):
     def cycle_timer(self, interval):
         raise NotImplementedError
 
-    def notify(self, account=None):
+    def schedule_update(self):
         raise NotImplementedError
 
+    def notify(self, account=None):
+        # May be called from any thread; a burst of notifications results
+        # in a single update
+        with self._lock:
+            self._dirty.add(account)
+            if self._update_pending:
+                return
+            self._update_pending = True
+        self.schedule_update()
+
     def has_account(self, account, require_active=False):
         return account.icon == self and account.icondata and \
             (account.icondata.active or not require_active)
@@ -77,7 +189,7 @@ class MailIconBase(object):
         assert threading.current_thread() == MAIN_THREAD
         # Determine the next account to display
         keys = self.app.accountnames
-        if self.displaying:
+        if self.displaying in keys:
             pos = keys.index(self.displaying) + 1
         else:
             pos = 0
@@ -92,58 +204,119 @@ class MailIconBase(object):
             self.displaying = eligible[0]
         self.refresh_display()
 
-    def update(self, account=None):
+    def update(self):
         assert threading.current_thread() == MAIN_THREAD
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = set()
+            self._update_pending = False
 
         # Monitor for dead threads
-        if account:
-            if account.icon != self:
-                return
-            account.icondata.updated(0)
-
-        # Determine how many active accounts we have for this icon
-        tooltip = []
-        total_messages = 0
-        current_active = False
-        for name in self.app.accountnames:
-            account = self.app.accounts[name]
-            self.refresh_account_icon(account)
-            count = account.count
-            if count:
-                tooltip.append("%s in %s" % (count, name))
-                if type(count) is int:
-                    total_messages += count
-                if self.displaying and name == self.displaying:
-                    current_active = True
-                account.icondata.active = True
-            else:
+        for account in dirty:
+            if account and self.has_account(account):
+                account.icondata.updated(0)
+
+        if None in dirty or any(x and x.name not in self._positions
+                                for x in dirty):
+            # Accounts were added, removed or reordered
+            accounts = [self.app.accounts[name]
+                        for name in self.app.accountnames]
+            accounts = [x for x in accounts if self.has_account(x)]
+            self._positions = dict((x.name, i)
+                                   for i, x in enumerate(accounts))
+            self._shown = sorted((self._positions[name], name)
+                                 for position, name in self._shown
+                                 if name in self._positions)
+            self._fragments = [self.app.accounts[name].icondata.tooltip
+                               for position, name in self._shown]
+        if None in dirty:
+            # Start over with every account
+            self._total = 0
+            self._active = 0
+            self._shown = []
+            self._fragments = []
+            for account in accounts:
+                account.icondata.messages = 0
                 account.icondata.active = False
-
-        # Update the tooltip
-        self.refresh_tooltip("%d new messages" % (total_messages,)
-                             if total_messages > 0 else "No new messages",
+            dirty = accounts
+        for account in dirty:
+            if self.has_account(account):
+                self._refresh_account(account)
+
+        # Update the tooltip from the accounts that have a share of it
+        tooltip = list(itertools.chain.from_iterable(self._fragments))
+        self.refresh_tooltip("%d new messages" % (self._total,)
+                             if self._total > 0 else "No new messages",
                              tooltip)
 
         # Do we need to be cycling between accounts?
-        self.log.info("%d active accounts" % len(tooltip))
-        self.cycle_timer(self.INTERVAL if len(tooltip) > 1 else None)
+        self.log.info("%d active accounts" % self._active)
+        cycling = self._active > 1
+        if cycling != self._cycling:
+            self._cycling = cycling
+            self.cycle_timer(self.INTERVAL if cycling else None)
 
         # If the currently displayed account has no mail, cycle immediately
+        current = self.app.accounts.get(self.displaying)
+        current_active = current and self.has_account(current, True)
         if (self.displaying and not current_active) or \
-            (not self.displaying and tooltip):
+            (not self.displaying and self._active):
             self.cycle()
-        else:
+        elif not current or current in dirty:
             self.refresh_display()
 
+    def _refresh_account(self, account):
+        # Re-render one account and update its share of the tooltip
+        data = account.icondata
+        self.refresh_account_icon(account)
+        count = account.count
+        tooltip = []
+        if count:
+            if account.stale:
+                # Left from a past run, until the first check finishes
+                tooltip.append("%s in %s (as of %s)" %
+                               (count, account.name,
+                                time.strftime('%H:%M', time.localtime(
+                                    account.checked or 0))))
+            else:
+                tooltip.append("%s in %s" % (count, account.name))
+            if account.counts:
+                # Show each mailbox of the account separately
+                tooltip.extend("  %s in %s" % (folder_count, folder)
+                               for folder, folder_count
+                               in account.counts.items() if folder_count)
+        # Splice the account's lines into the tooltip
+        key = (self._positions[account.name], account.name)
+        i = bisect.bisect_left(self._shown, key)
+        shown = i < len(self._shown) and self._shown[i] == key
+        if tooltip and not shown:
+            self._shown.insert(i, key)
+            self._fragments.insert(i, tooltip)
+        elif shown and not tooltip:
+            del self._shown[i]
+            del self._fragments[i]
+        elif shown:
+            self._fragments[i] = tooltip
+        messages = count if type(count) is int else 0
+        self._total += messages - data.messages
+        self._active += bool(count) - data.active
+        data.tooltip = tooltip
+        data.messages = messages
+        data.active = bool(count)
+
     def check_obsolete(self):
         assert threading.current_thread() == MAIN_THREAD
+        if not self.app.scheduler.online:
+            return      # Checkers are paused
         now = time.time()
         for account in self.app.accounts.values():
             if not self.has_account(account):
                 continue
             when, strikes = account.icondata.updatetime
-            if now > when + account.interval*3/2:
-                # FIXME: use Network Manager
+            # Accounts waiting for a scheduled check, e.g. backing off after
+            # errors, are not expected to report until then
+            due = self.app.scheduler.due(account) or 0
+            if now > max(when, due) + account.interval*3/2:
                 if strikes >= 1:
                     account.log.warning("Respawning thread")
                     account.icondata.updated(0)
@@ -165,10 +338,12 @@ class MailIconBase(object):
         self.notify()
 
 class MultiowlApp(object):
-    def __init__(self, ui):
+    def __init__(self, ui, engine='thread', monitor=None):
         self.log = logging.getLogger(self.__class__.__name__)
         self.lock = threading.Lock()
         self.ui = ui
+        self.startup = OrderedDict()    # Seconds spent in each startup step
+        self._startup_mark = time.time()
 
         # Check single-instance
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
@@ -180,31 +355,78 @@ class MultiowlApp(object):
             trigger()
             return
         self.service = DBusService(self)
+        self._startup_step('dbus')
 
         # Icons
         self.icons = {}
 
+        # Run checkers on one shared event loop, or one thread per account
+        self.scheduler = Scheduler()
+        self.loop = None
+        if engine == 'loop':
+            from .eventloop import CheckerLoop
+            self.loop = CheckerLoop()
+        self._startup_step('engine')
+
         # Accounts
         self.passwords = configmgr.PasswordManager()
         self.accounts = {}
         self.accountnames = []
-
-        # Read configuration
+        self.configs = {}       # Account name -> the config it was added with
+        self._startup_step('keyring')
+
+        # Pause checkers while offline. monitor may be a ConnectivityMonitor,
+        # e.g. a stand-in driven by set_online, or a callable returning one
+        monitor = monitor or connectivity.create_monitor
+        if not isinstance(monitor, connectivity.ConnectivityMonitor):
+            monitor = monitor()
+        self.connectivity = monitor
+        self.connectivity.add_listener(self.connectivity_changed)
+        if not self.connectivity.online:
+            self.scheduler.pause()
+        self._startup_step('connectivity')
+
+        # Read configuration, and the accounts' state from the last run
         self.config = configmgr.Config()
         self.configurator = self.ui.MultiowlConfigurator(self) # FIXME
+        self.state = StateCache(configmgr.cache_file('state.json'))
+        self.state.load()
+        self._startup_step('config')
+        # Passwords are looked up in the background from here on, and each
+        # check waits only for its own
         self.add_accounts()
+        self._startup_step('accounts')
+        # Apply changes to the configuration as they are saved
+        self.config_watcher = configmgr.ConfigWatcher(
+            lambda: self.ui.call_later(0, self.reload_config))
+        self.config_watcher.start()
+        # kill -USR1 writes out every account's flight recorder, from the
+        # main loop: the handler may interrupt code holding a recorder's lock
+        signal.signal(signal.SIGUSR1, lambda signum, frame:
+                      self.ui.call_later(0, self.dump_flight_record))
+        self.log.info("Startup took %.3f sec (%s)" %
+                      (sum(self.startup.values()),
+                       ', '.join('%s %.3f' % x for x in self.startup.items())))
 
         self.ui.main()     # FIXME: Rewrite in Qt
+        self.state.flush()
+
+    def _startup_step(self, name):
+        now = time.time()
+        self.startup[name] = now - self._startup_mark
+        self._startup_mark = now
 
     def add_account(self, config, index=None): #account, color):
         assert threading.current_thread() == MAIN_THREAD
+        # Keep the settings as read for reload_config to compare against,
+        # whatever the account does with the dict it is given
+        saved = dict(config)
         account_name = config['name']
-        account_type = config['type'].lower()
-        if not account_type.isalnum():
-            self.log.error("Invalid account type: %s" % (config['type'],))
+        try:
+            module = account_module(config['type'])
+        except ValueError as e:
+            self.log.error(str(e))
             return
-        account_module = importlib.import_module('.account.' + account_type,
-                                                 'multiowl')
         with self.lock:
             # Find icon for this account
             icon = config['icon']
@@ -213,18 +435,107 @@ class MultiowlApp(object):
                 self.icons[icon] = self.ui.MailIcon(self)
             icon = self.icons[icon]
 
-            account = account_module.Account(config, icon)
+            account = module.Account(config, icon)
+            self.state.restore(account)
             icon.add_account(account, config)
 
             if index is None:
                 index = len(self.accountnames)
             self.accounts[account_name] = account
             self.accountnames.insert(index, account_name)
+            self.configs[account_name] = saved
 
-    def remove_account(self, account):
+    def remove_account(self, account, restart=False):
+        # When the account is being restarted with new settings, keep what
+        # it left in the caches for the new one
         assert threading.current_thread() == MAIN_THREAD
-        account.icon.remove_account(account)
-        del self.accounts[account.name]
+        with self.lock:
+            icon = account.icon
+            del self.accounts[account.name]
+            self.accountnames.remove(account.name)
+            del self.configs[account.name]
+        # Its checker exits and its connection is closed; nothing refers to
+        # the account any more once the icon has been updated
+        icon.remove_account(account)
+        if not restart:
+            self.state.forget(account.name)
+            self._delete_cache_files(account.cache_files())
+        self.service.count_changed(account)
+
+    def _delete_cache_files(self, paths):
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    self.log.warning("Unable to delete %s: %s" % (path, e))
+
+    def reload_config(self):
+        # Bring the running accounts in line with the configuration file,
+        # leaving those whose settings have not changed alone
+        assert threading.current_thread() == MAIN_THREAD
+        config = configmgr.Config()
+        configs = list(config.accounts())
+        names = [x['name'] for x in configs]
+        for name in list(self.accountnames):
+            if name not in names:
+                self.log.info("Removing account %s" % (name,))
+                self.remove_account(self.accounts[name])
+        for index, new in enumerate(configs):
+            name = new['name']
+            old = None
+            if name in self.configs:
+                if self.configs[name] == new:
+                    continue
+                self.log.info("Restarting account %s" % (name,))
+                old = self.accounts[name]
+                self.remove_account(old, restart=True)
+            else:
+                self.log.info("Adding account %s" % (name,))
+            self.add_account(new, min(index, len(self.accountnames)))
+            if old:
+                # Caches the new settings no longer use, e.g. for another
+                # server or mailbox
+                kept = self.accounts[name].cache_files() \
+                    if name in self.accounts else []
+                self._delete_cache_files(set(old.cache_files()) - set(kept))
+        with self.lock:
+            self.accountnames.sort(key=names.index)
+        self.config = config
+        for icon in self.icons.values():
+            icon.notify()
+
+    def dump_flight_record(self):
+        path = configmgr.cache_file('flightrecord.txt')
+        try:
+            with open(path, 'w') as f:
+                recorder.dump(self, f)
+        except (IOError, OSError):
+            self.log.exception("Unable to write flight record")
+            return
+        self.log.warning("Wrote flight record to %s" % (path,))
+
+    def count_changed(self, account):
+        self.state.record(account)
+        self.service.count_changed(account)
+
+    def connectivity_changed(self, online):
+        assert threading.current_thread() == MAIN_THREAD
+        if not online:
+            self.log.warning("Offline; pausing checks")
+            self.scheduler.pause()
+            return
+        # Replace every checker, since existing connections are likely dead;
+        # the scheduler limits how many connect at once
+        self.log.warning("Online; reconnecting all accounts")
+        self.scheduler.resume()
+        for name in self.accountnames:
+            account = self.accounts[name]
+            if account.icondata:
+                account.icondata.updated(0)
+            account.spawn_thread()
+        if self.loop:
+            self.loop.resume()
 
     def add_accounts(self):
         for config in self.config.accounts():
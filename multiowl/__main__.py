@@ -1,8 +1,31 @@
 import logging
+import argparse
+import sys, json
+
+parser = argparse.ArgumentParser(prog='multiowl')
+parser.add_argument('--engine', choices=('thread', 'loop'), default='thread',
+                    help="run each account in its own thread (default), or "
+                    "all accounts on one shared event loop")
+parser.add_argument('--check', action='store_true',
+                    help="check every account once without a GUI, print the "
+                    "counts as JSON and exit")
+parser.add_argument('--workers', type=int,
+                    help="accounts to check at once with --check")
+args = parser.parse_args()
+
+if args.check:
+    # Headless: must not import GTK
+    logging.basicConfig(level=logging.WARNING,
+                        format="<%(name)s> %(message)s")
+    from .oneshot import OneShotApp
+    report = OneShotApp(workers=args.workers).report()
+    print json.dumps(report, indent=2)
+    sys.exit(1 if report['errors'] else 0)
+
 from . import gtkinterface
 from .__init__ import MultiowlApp
 
 logging.basicConfig(level=logging.DEBUG,
                     datefmt='%Y-%m-%d %H:%M:%S',
                     format="[%(asctime)s] %(threadName)s <%(name)s> %(message)s")
-MultiowlApp(gtkinterface)
+MultiowlApp(gtkinterface, engine=args.engine)
@@ -2,16 +2,67 @@ import logging
 
 import threading
 import time
+import select
+import importlib
+from contextlib import contextmanager
+
+from ..metrics import AccountMetrics
+from ..recorder import FlightRecorder
+
+def account_module(account_type):
+    # The module implementing an account type, e.g. multiowl.account.imap
+    if not account_type.isalnum():
+        raise ValueError("Invalid account type: %s" % (account_type,))
+    return importlib.import_module('.' + account_type.lower(), __name__)
+
+class Wait(object):
+    """Yielded by a watcher to wait for a socket to become readable, or
+    simply to sleep when no socket is given.
+
+    The engine driving the watcher sets ready once the wait is over."""
+    def __init__(self, timeout, sock=None):
+        self.timeout = timeout
+        self.sock = sock
+        self.ready = False
+
+    def block(self):
+        # Wait in the calling thread
+        if self.sock is None:
+            time.sleep(self.timeout)
+            return
+        ready = select.select((self.sock,), (), (self.sock,), self.timeout)
+        self.ready = self.sock in ready[0]
+
+def close_watcher(account, watcher):
+    # Stop a watcher early, running its cleanup (e.g. logging out), which
+    # may fail if the connection has already been closed
+    try:
+        watcher.close()
+    except Exception:
+        account.log.debug("Error while closing watcher", exc_info=True)
 
 class Account(object):
+    # Seconds each phase of a check may take before the account's connection
+    # is closed under it ('idle' is on top of the interval), and the socket
+    # timeouts for connecting, the TLS handshake and other reads and writes
+    TIMEOUTS = {'connect': 30, 'tls': 30, 'greeting': 30, 'login': 60,
+                'select': 120, 'search': 120, 'fetch': 120, 'idle': 60,
+                'logout': 30, 'io': 120}
+
     def __init__(self, config, icon):
         self.name = config['name']
         self.log = logging.getLogger(self.name)
         self.interval = config['interval']
 
         self._count = '?'
+        self.counts = None
+        self.error = None       # Why the last check failed
+        self.stale = False      # Whether the count is left from a past run
+        self.checked = None
         self._password = None
         self._thread = None
+        self.metrics = AccountMetrics()
+        self.recorder = FlightRecorder()
 
         self.icon = icon
         self.icondata = None
@@ -22,19 +73,34 @@ class Account(object):
         self.spawn_thread()
 
     def stop(self):
-        # FIXME: clarify relationship between account, icon, icondata
-        raise Exception
-        #account.icondata = None
-        #account.icon = None
-        #if self._thread:
-        #    self._thread.abort = True
+        # Stop checking for good: the checker exits without reporting
+        # anything more, and the connection is closed at once
+        self.recorder.record('stop')
+        thread, self._thread = self._thread, None
+        if thread:
+            thread.abort = True
+        self.abort_io()
+        if thread and self.app.loop:
+            self.app.loop.cancel(thread)
+        self.app.scheduler.forget(self)
+        self.icondata = None
+        self.icon = None
 
     def spawn_thread(self):
+        self.recorder.record('spawn', 'replacing checker' if self._thread
+                             else '')
         if self._thread:
             self._thread.abort = True
+            self.abort_io()
             self.log.warning("Aborting existing thread")
-        self._thread = CheckerThread(self)
-        self._thread.start()
+            if self.app.loop:
+                self.app.loop.cancel(self._thread)
+        if self.app.loop:
+            # Run as a task on the shared event loop
+            self._thread = self.app.loop.spawn(self)
+        else:
+            self._thread = CheckerThread(self)
+            self._thread.start()
 
     @property
     def password(self):
@@ -45,9 +111,10 @@ class Account(object):
 
     @password.setter
     def password(self, value):
+        # Look the password up in the background; reading it waits for that
         self._password = value
         self.log.debug("Loading password for %s" % (self._password,))
-        self.app.passwords.load(self._password)
+        self.app.passwords.prefetch(self._password)
 
     @property
     def count(self):
@@ -55,18 +122,75 @@ class Account(object):
 
     @count.setter
     def count(self, value):
+        # Accounts watching several mailboxes give a dict of counts
+        self.counts = None
+        if isinstance(value, dict):
+            self.counts = value
+            known = [x for x in value.values() if type(x) is int]
+            value = sum(known) if known else '?'
         self._count = value
+        self.stale = False
+        self.checked = time.time()
+        if value != '?':
+            self.error = None
         self.log.info("Got %s messages" % (self._count,))
-        if self.icon:
+        self.recorder.record('count', str(self._count))
+        if self.icon:   # Not once stopped
             self.icon.notify(self)
+            self.app.count_changed(self)
+
+    def failed(self, exc):
+        # A check failed with the given exception
+        self.metrics.error(exc)
+        self.error = '%s: %s' % (exc.__class__.__name__, exc)
+        self.recorder.record('error', self.error)
+        self.count = '?'
+
+    def restore(self, entry):
+        # Start from the count saved by a past run, until the first check
+        self._count = entry['count']
+        self.counts = entry.get('counts')
+        self.checked = entry.get('checked')
+        self.stale = True
+
+    def cache_state(self):
+        # Anything else worth keeping in the state cache
+        return {}
+
+    def cache_files(self):
+        # Files the account keeps in the cache directory, deleted with it
+        return []
+
+    def abort_io(self):
+        # Close the account's connection, so that anything blocked on it
+        # fails at once
+        pass
+
+    @contextmanager
+    def phase(self, name, extra=0):
+        # Abort the account's I/O if this phase runs past its deadline, and
+        # record how long it took
+        start = time.time()
+        try:
+            with self.app.scheduler.deadline(self.TIMEOUTS[name] + extra,
+                                             lambda: self._overdue(name),
+                                             "%s: %s" % (self.name, name)):
+                yield
+        finally:
+            self.metrics.observe(name, time.time() - start)
+
+    def _overdue(self, phase):
+        self.recorder.record('deadline', phase)
+        self.abort_io()
 
     def check(self):
         raise NotImplementedError
 
     def watch(self):
+        # Yields unread counts, or Wait objects while there is nothing to do
         while True:
             yield self.check()
-            time.sleep(self.interval)
+            yield Wait(self.app.scheduler.poll_delay(self))
 
 class CheckerThread(threading.Thread):
     def __init__(self, account):
@@ -79,25 +203,43 @@ class CheckerThread(threading.Thread):
 
     def run(self):
         # Fetch/monitor unread count
+        scheduler = self.account.app.scheduler
+        try:
+            time.sleep(scheduler.first_delay(self.account))
+        except KeyboardInterrupt:
+            return
         while not self.abort:
-            minwatch = time.time() + self.account.interval
+            watcher = None
             try:
+                scheduler.wait_online()
+                if self.abort:
+                    break
                 watcher = self.account.watch()
                 for count in watcher:
                     if self.abort:
                         break
-                    self.account.count = count
+                    if isinstance(count, Wait):
+                        count.block()
+                    else:
+                        scheduler.checked(self.account, count)
+                        self.account.count = count
             except KeyboardInterrupt:
                 break
-            except Exception:
+            except Exception as e:
+                if self.abort:
+                    break       # The connection was closed under it
                 self.account.log.exception("Got an exception")
-                self.account.count = '?'
+                self.account.failed(e)
+            finally:
+                if watcher and self.abort:
+                    close_watcher(self.account, watcher)
+            if self.abort:
+                break
             try:
-                diffwatch = minwatch - time.time()
-                if diffwatch > 0:
-                    self.account.log.info("Waiting %d sec before retrying" %
-                                          (diffwatch,))
-                    time.sleep(diffwatch)
+                delay = scheduler.failed(self.account)
+                self.account.log.info("Waiting %d sec before retrying" %
+                                      (delay,))
+                time.sleep(delay)
             except KeyboardInterrupt:
                 break
         self.account.log.warning("Thread exiting")
@@ -1,56 +1,292 @@
 from .. import sslutils
-from . import Account
-from .imap import AccountIMAP
+from ..metrics import CountingSocket
+from . import Account, Wait
+from .imap import AccountIMAP, imap_idle, seqset
 
-import urllib2
-from xml.dom import minidom
+import httplib, socket
+import re
+import urllib, base64
+from xml.parsers import expat
+from collections import OrderedDict
+
+class GmailUnread(object):
+    """The unread messages carrying any of the watched labels, as a set of
+    X-GM-MSGIDs, so that a message with several of the labels is counted
+    once. Each search only fetches the msgids of UIDs it has not seen
+    before, and the set is updated with what was added and removed."""
+
+    MSGID_RE = re.compile(r'\bX-GM-MSGID (\d+)')
+    UID_RE = re.compile(r'\bUID (\d+)')
+
+    def __init__(self):
+        self.uidvalidity = None
+        self.msgids = {}        # UID in All Mail -> X-GM-MSGID
+        self.unread = set()
+
+    @property
+    def count(self):
+        return len(self.unread)
+
+    def reset(self, uidvalidity):
+        self.uidvalidity = uidvalidity
+        self.msgids = {}
+        self.unread = set()
+
+    def update(self, uids, fetched):
+        # uids are the UIDs now unread under the labels; fetched is a list
+        # of FETCH responses giving the msgids of those not yet known
+        for data in fetched:
+            uid = self.UID_RE.search(data)
+            msgid = self.MSGID_RE.search(data)
+            if uid and msgid:
+                self.msgids[int(uid.group(1))] = int(msgid.group(1))
+        uids = set(uids)
+        for uid in [x for x in self.msgids if x not in uids]:
+            self.unread.discard(self.msgids.pop(uid))
+        for uid in uids:
+            if uid in self.msgids:
+                self.unread.add(self.msgids[uid])
+
+LIST_RE = re.compile(r'\(([^)]*)\) (?:"(?:[^"\\]|\\.)*"|NIL) (.*)$')
+
+def label_query(labels):
+    # Gmail search terms for unread messages with any of the labels, where
+    # {a b} means a OR b
+    terms = []
+    for label in labels:
+        name = label.lstrip('\\').lower()
+        if name == 'inbox':
+            terms.append('in:inbox')
+        else:
+            terms.append('label:' + re.sub(r'[\s/]+', '-', name))
+    if len(terms) == 1:
+        return 'is:unread ' + terms[0]
+    return 'is:unread {%s}' % (' '.join(terms),)
 
 class AccountGmailIMAP(AccountIMAP):
+    ALL_MAIL = '[Gmail]/All Mail'
+
     def __init__(self, config, icon):
-        config['server'] = 'imap.googlemail.com'
+        config = dict(config, server='imap.googlemail.com')
         super(AccountGmailIMAP, self).__init__(config, icon)
         self.password = self.username
+        # With labels, count the unread mail under any of them by searching
+        # All Mail with Gmail's IMAP extensions, rather than one folder
+        self.labels = [x.strip() for x in config.get('labels', '').split(',')
+                       if x.strip()]
+        self._unread = GmailUnread()
+
+    def _select(self, imap):
+        if self.labels:
+            if 'X-GM-EXT-1' not in imap.capabilities:
+                raise imap.error("Server does not support X-GM-EXT-1, "
+                                 "needed for labels")
+            self.mailbox = self._all_mail(imap)
+            self._folders.clear()
+        super(AccountGmailIMAP, self)._select(imap)
+        if self.labels:
+            uidvalidity = int(imap.untagged_responses.pop(
+                'UIDVALIDITY', ['0'])[-1])
+            if uidvalidity != self._unread.uidvalidity:
+                self._unread.reset(uidvalidity)
+
+    def _examine_params(self, imap):
+        # The saved state is the inbox's, so it means nothing to All Mail
+        if self.labels:
+            return None
+        return super(AccountGmailIMAP, self)._examine_params(imap)
+
+    def cache_state(self):
+        if self.labels:
+            return {'uidvalidity': self._unread.uidvalidity}
+        return super(AccountGmailIMAP, self).cache_state()
+
+    def _all_mail(self, imap):
+        # Gmail localises folder names, so find All Mail by its attribute
+        typ, data = imap.list()
+        for item in data if typ == 'OK' else ():
+            match = isinstance(item, str) and LIST_RE.match(item)
+            if match and '\\all' in match.group(1).lower().split():
+                name = match.group(2)
+                if name.startswith('"'):
+                    name = re.sub(r'\\(.)', r'\1', name[1:-1])
+                return name
+        return self.ALL_MAIL
+
+    def _search_labels(self, imap):
+        # In parentheses, so that imaplib passes it through unquoted
+        criteria = '(X-GM-RAW %s)' % (imap._quote(label_query(self.labels)),)
+        uids = self._uid_search(imap, criteria)
+        new = [x for x in uids if x not in self._unread.msgids]
+        fetched = []
+        if new:
+            typ, data = imap.uid('FETCH', seqset(new), '(X-GM-MSGID)')
+            assert typ == 'OK'
+            fetched = [x[0] if isinstance(x, tuple) else x
+                       for x in data if x]
+        self._unread.update(uids, fetched)
+        # Nothing else is tracked from All Mail's untagged responses
+        for response in ('EXISTS', 'RECENT', 'EXPUNGE', 'FETCH'):
+            imap.untagged_responses.pop(response, None)
+        return self._unread.count
+
+    def watch(self):
+        if not self.labels:
+            return super(AccountGmailIMAP, self).watch()
+        return self._watch_labels()
+
+    def _watch_labels(self):
+        with self._connect() as imap:
+            while True:
+                with self.phase('search'):
+                    count = self._search_labels(imap)
+                yield count
+                if 'IDLE' not in imap.capabilities:
+                    yield Wait(self.app.scheduler.poll_delay(self))
+                    continue
+                # Any change to All Mail ends IDLE, to search again
+                with self.phase('idle', self.interval):
+                    for item in imap_idle(imap, timeout=self.interval):
+                        yield item
+
+    def check(self):
+        if not self.labels:
+            return super(AccountGmailIMAP, self).check()
+        with self._connect() as imap, self.phase('search'):
+            return self._search_labels(imap)
+
+class _FullCount(Exception):
+    pass
+
+def parse_fullcount(response, blocksize=1024):
+    # Parse an Atom feed only as far as its <fullcount> element
+    parser = expat.ParserCreate()
+    text = []
+    def start(name, attrs):
+        if name.rsplit(':', 1)[-1] == 'fullcount':
+            parser.CharacterDataHandler = text.append
+    def end(name):
+        if name.rsplit(':', 1)[-1] == 'fullcount':
+            raise _FullCount(int(''.join(text)))
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    try:
+        while True:
+            data = response.read(blocksize)
+            parser.Parse(data, not data)
+            if not data:
+                raise ValueError("No fullcount in feed")
+    except _FullCount as e:
+        return e.args[0]
+
+class AtomFeed(object):
+    """Validators and last count of one feed, for conditional requests."""
+    def __init__(self, path):
+        self.path = path
+        self.etag = None
+        self.modified = None
+        self.count = None
 
 class AccountGmailAtom(Account):
-    class MyPasswordMgr(object):
-        def __init__(self, account):
-            self.account = account
-            self.uri = None
-            self.user = None
-            self.password = None
-        def add_password(self, realm, uri, user, passwd):
-            self.uri = uri
-            self.user = user
-            self.password = passwd
-        def find_user_password(self, realm, authuri):
-            if authuri == self.uri:
-                return (self.user, self.password)
-            else:
-                return (None, None)
+    HOST = 'mail.google.com'
+    PATH = '/mail/feed/atom'
 
     def __init__(self, config, icon):
         super(AccountGmailAtom, self).__init__(config, icon)
 
         self.username = config['username']
         self.password = self.username
-        self.password_mgr = self.MyPasswordMgr(self)
-        auth_handler = urllib2.HTTPBasicAuthHandler(self.password_mgr)
-        https_handler = sslutils.VerifiedHTTPSHandler()
-        self.url_opener = urllib2.build_opener(auth_handler, https_handler)
+        # Feeds to watch: the inbox, or each of the listed labels
+        labels = [x.strip() for x in config.get('labels', '').split(',')
+                  if x.strip()]
+        self._feeds = OrderedDict(
+            (label, AtomFeed('%s/%s' % (self.PATH, urllib.quote(label))))
+            for label in labels) or \
+            OrderedDict([(None, AtomFeed(self.PATH))])
+        # Persistent HTTPS connection
+        self._conn = None
         # Future: Use XMPP?
 
-    def check(self):
-        handle = None
-        url = 'https://mail.google.com/mail/feed/atom'
-        self.password_mgr.add_password(['New mail feed', 'mail.google.com'],
-                                       url, self.username, self.password)
+    def _close(self, conn):
+        if self._conn is conn:
+            self._conn = None
+        conn.close()
+
+    def abort_io(self):
+        # The next check will connect afresh
+        conn, self._conn = self._conn, None
+        if conn and conn.sock:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _fetch(self):
+        conn = self._conn
+        reused = conn is not None
+        if not reused:
+            with self.app.scheduler.connecting(self.HOST):
+                # Socket timeout for connecting and the TLS handshake
+                conn = sslutils.VerifiedHTTPSConnection(
+                    self.HOST, timeout=self.TIMEOUTS['connect'])
+                self.recorder.record('connect', self.HOST)
+                conn.connect()
+                self.metrics.observe('connect', conn.connect_time)
+                self.metrics.observe('tls', conn.tls_time)
+                self._conn = conn
+        with self.phase('fetch'):
+            return self._pipeline(conn, reused)
+
+    def _pipeline(self, conn, reused):
+        sock = CountingSocket(conn.sock, self.metrics)
+        auth = base64.b64encode('%s:%s' % (self.username, self.password))
+
+        # Send the requests for all feeds at once, then read the responses
+        # in order (HTTP/1.1 pipelining)
         try:
-            handle = self.url_opener.open(url)
-            dom = minidom.parse(handle)
-            fullcount = dom.getElementsByTagName('fullcount')[0]
-            return int(fullcount.firstChild.data)
-        finally:
-            if handle:
-                handle.close()
+            for feed in self._feeds.values():
+                request = ['GET %s HTTP/1.1' % (feed.path,),
+                           'Host: %s' % (self.HOST,),
+                           'Authorization: Basic %s' % (auth,),
+                           'Accept-Encoding: identity']
+                if feed.etag:
+                    request.append('If-None-Match: %s' % (feed.etag,))
+                if feed.modified:
+                    request.append('If-Modified-Since: %s' % (feed.modified,))
+                sock.sendall('\r\n'.join(request) + '\r\n\r\n')
+            will_close = False
+            for feed in self._feeds.values():
+                response = httplib.HTTPResponse(sock, method='GET')
+                response.begin()
+                self.recorder.record('response', '%d %s' % (response.status,
+                                                            feed.path))
+                if response.status == httplib.OK:
+                    feed.count = parse_fullcount(response)
+                    feed.etag = response.getheader('etag')
+                    feed.modified = response.getheader('last-modified')
+                elif response.status != httplib.NOT_MODIFIED:
+                    raise httplib.HTTPException("%s: %d %s" %
+                                                (feed.path, response.status,
+                                                 response.reason))
+                # Finish reading the body to keep the connection usable
+                response.read()
+                will_close = will_close or response.will_close
+        except Exception as e:
+            self._close(conn)
+            if reused and isinstance(e, (httplib.HTTPException,
+                                         socket.error)):
+                # The server may have closed the idle connection; retry
+                # once on a new one
+                return self._fetch()
+            raise
+        if will_close:
+            self._close(conn)
+
+    def check(self):
+        self._fetch()
+        if None in self._feeds:
+            return self._feeds[None].count
+        return OrderedDict((label, feed.count)
+                           for label, feed in self._feeds.items())
 
 Account = AccountGmailIMAP
@@ -1,40 +1,441 @@
-from . import Account
+from . import Account, Wait
 from .. import sslutils
+from .. import config as configmgr
+from ..metrics import AccountMetrics
+from ..recorder import FlightRecorder
 
 import imaplib
 from contextlib import contextmanager
-import socket, select
+import socket
 import time
+import zlib
+import re, array, bisect
+import os, json, urllib
+from collections import OrderedDict
+
+# RFC 5161, needed to turn on QRESYNC
+imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+# RFC 5465
+imaplib.Commands.setdefault('NOTIFY', ('AUTH', 'SELECTED'))
+# RFC 4978
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+class DeflateFile(object):
+    """Reads the server's side of a COMPRESS=DEFLATE connection, standing in
+    for the file that imaplib reads responses from."""
+
+    BLOCKSIZE = 16384
+
+    def __init__(self, sslobj, metrics, data=''):
+        self.sslobj = sslobj
+        self.metrics = metrics
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buf = ''
+        if data:
+            self._inflate(data)
+
+    def _inflate(self, data):
+        plain = self.decompressor.decompress(data)
+        self.metrics.compressed(wire_in=len(data), plain_in=len(plain))
+        self.buf += plain
+
+    def _fill(self):
+        data = self.sslobj.read(self.BLOCKSIZE)
+        if not data:
+            return False
+        self._inflate(data)
+        return True
+
+    def pending(self):
+        # Whether responses have already been decompressed, so that select()
+        # would not report them
+        return bool(self.buf)
+
+    def read(self, size):
+        while len(self.buf) < size and self._fill():
+            pass
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def readline(self, size=-1):
+        start = 0
+        while '\n' not in self.buf[start:]:
+            start = len(self.buf)
+            if 0 <= size <= start or not self._fill():
+                break
+        end = self.buf.find('\n', start) + 1 or len(self.buf)
+        if size >= 0:
+            end = min(end, size)
+        data, self.buf = self.buf[:end], self.buf[end:]
+        return data
+
+    def close(self):
+        pass
 
 # An IMAP4_SSL implementation that uses my_wrap_socket to verify certificates
 class IMAP4_VerifiedSSL(imaplib.IMAP4_SSL):
+    def __init__(self, host='', port=imaplib.IMAP4_SSL_PORT, timeouts=None,
+                 metrics=None, recorder=None, opening=None):
+        # Socket timeouts for connecting, the TLS handshake, and any single
+        # read or write after that
+        self.timeouts = timeouts or {}
+        self.metrics = metrics or AccountMetrics()
+        self.recorder = recorder or FlightRecorder()
+        self.refcount = 0
+        self.aborted = False
+        self.sock = None
+        self.compressor = None
+        # Called with the connection before it connects, so that it can be
+        # aborted while waiting for the greeting or CAPABILITY
+        if opening:
+            opening(self)
+        try:
+            imaplib.IMAP4_SSL.__init__(self, host, port)
+        except Exception:
+            # Do not leak the connection if the greeting or CAPABILITY fails
+            for sock in (getattr(self, 'sslobj', None), self.sock):
+                if sock:
+                    sock.close()
+            raise
+        self.recorder.record('capability', ' '.join(self.capabilities))
+
     def open(self, host='', port=imaplib.IMAP4_SSL_PORT):
         self.host = host
         self.port = port
-        self.sock = socket.create_connection((host, port))
+        start = time.time()
+        self.recorder.record('connect', '%s:%d' % (host, port))
+        self.sock = socket.create_connection((host, port),
+                                             self.timeouts.get('connect'))
+        if self.aborted:
+            raise self.abort('connection aborted')
+        connected = time.time()
+        self.metrics.observe('connect', connected - start)
+        self.sock.settimeout(self.timeouts.get('tls'))
         self.sslobj = sslutils.my_wrap_socket(self.sock, self.keyfile,
                                               self.certfile,
                                               server_hostname=host)
+        self.metrics.observe('tls', time.time() - connected)
+        self.recorder.record('tls', '%s %s' % self.sslobj.cipher()[1::-1])
+        self.sslobj.settimeout(self.timeouts.get('io'))
         self.file = self.sslobj.makefile('rb')
 
-def imap_idle(imap, timeout=29*60):
+    def login(self, user, password):
+        typ, dat = imaplib.IMAP4_SSL.login(self, user, password)
+        # Servers may advertise more once logged in, e.g. COMPRESS, usually
+        # in the response code, which imaplib does not look at
+        capabilities = self.untagged_responses.pop('CAPABILITY', None)
+        match = dat and isinstance(dat[-1], str) and \
+            re.match(r'\[CAPABILITY ([^\]]*)\]', dat[-1], re.I)
+        if match:
+            capabilities = [match.group(1)]
+        self.recorder.record('login', user)
+        if capabilities:
+            self.capabilities = tuple(capabilities[-1].upper().split())
+            self.recorder.record('capability', ' '.join(self.capabilities))
+        return typ, dat
+
+    def compress(self):
+        # Turn on COMPRESS=DEFLATE (RFC 4978); everything after the tagged
+        # response is compressed both ways
+        typ, dat = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            return False
+        self.recorder.record('compress', 'DEFLATE')
+        rbuf = getattr(self.file, '_rbuf', None)
+        self.file = DeflateFile(self.sslobj, self.metrics,
+                                rbuf.getvalue() if rbuf else '')
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, -zlib.MAX_WBITS)
+        return True
+
+    # Count the traffic
+    def read(self, size):
+        data = imaplib.IMAP4_SSL.read(self, size)
+        self.metrics.transferred(bytes_in=len(data))
+        return data
+
+    def readline(self):
+        data = imaplib.IMAP4_SSL.readline(self)
+        self.metrics.transferred(bytes_in=len(data))
+        # Record responses, but not what follows literals
+        if data.startswith('*'):
+            self.recorder.record('untagged', data.rstrip())
+        elif data.startswith(getattr(self, 'tagpre', '*')):
+            self.recorder.record('tagged', data.rstrip())
+        return data
+
+    def send(self, data):
+        size = len(data)
+        if self.compressor:
+            # Flush each command, since the server cannot answer it before
+            data = self.compressor.compress(data) + \
+                self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.metrics.compressed(wire_out=len(data), plain_out=size)
+        imaplib.IMAP4_SSL.send(self, data)
+        self.metrics.transferred(bytes_out=size)
+
+    def abort_io(self):
+        # Make reads and writes fail, without closing the file descriptor
+        # (which may be in use by select)
+        self.aborted = True
+        self.recorder.record('abort')
+        if not self.sock:
+            return      # Still connecting; open() will see aborted
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+class MailboxState(object):
+    """A compact model of the selected mailbox: the UID of every message,
+    indexed by sequence number, and the set of unseen UIDs.  It is updated
+    from untagged EXISTS, EXPUNGE and FETCH responses, so that most changes
+    can be counted without another round trip to the server."""
+
+    UID_RE = re.compile(r'\bUID (\d+)')
+    FLAGS_RE = re.compile(r'\bFLAGS \(([^)]*)\)')
+    MODSEQ_RE = re.compile(r'\bMODSEQ \((\d+)\)')
+
+    def __init__(self):
+        self.reset((), ())
+        # For RFC 7162 resynchronisation
+        self.uidvalidity = None
+        self.modseq = None
+
+    def load(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        self.reset(parse_seqset(data['uids']), parse_seqset(data['unseen']))
+        self.uidvalidity = data['uidvalidity']
+        self.modseq = data['modseq']
+
+    def save(self, path):
+        data = {'uidvalidity': self.uidvalidity, 'modseq': self.modseq,
+                'uids': seqset(self.uids), 'unseen': seqset(self.unseen)}
+        # Replace atomically
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(path + '.tmp', path)
+
+    def reset(self, uids, unseen):
+        self.uids = array.array('L', uids)
+        self.unseen = set(unseen)
+        # Number of messages in the mailbox; the UIDs of any messages past
+        # the end of self.uids are not yet known.
+        self.exists = len(self.uids)
+
+    @property
+    def count(self):
+        return len(self.unseen)
+
+    def set_uids(self, uids):
+        self.uids = array.array('L', sorted(uids))
+        self.unseen.intersection_update(self.uids)
+        self.exists = len(self.uids)
+
+    def merge(self, vanished, changes):
+        # Bring the state up to date with UIDs expunged since it was saved
+        # and the FETCH responses of messages changed since
+        uids = set(self.uids)
+        uids.difference_update(vanished)
+        for data in changes:
+            uid = self.UID_RE.search(data)
+            if not uid:
+                continue
+            uid = int(uid.group(1))
+            uids.add(uid)
+            self._flags(uid, data)
+        self.set_uids(uids)
+
+    def vanish(self, uids):
+        for uid in uids:
+            pos = bisect.bisect_left(self.uids, uid)
+            if pos < len(self.uids) and self.uids[pos] == uid:
+                self.uids.pop(pos)
+                self.unseen.discard(uid)
+                self.exists -= 1
+
+    @property
+    def missing(self):
+        # Range of sequence numbers that still need to be fetched
+        if self.exists > len(self.uids):
+            return (len(self.uids) + 1, self.exists)
+        return None
+
+    def update(self, resp):
+        # Apply an untagged response, without the leading '* '. Returns
+        # False if the response is not about the mailbox's messages.
+        parts = resp.split(None, 2)
+        if len(parts) >= 2 and parts[0].upper() == 'VANISHED':
+            # Handle '* VANISHED 405,407:410' (with QRESYNC enabled)
+            self.vanish(parse_seqset(parts[-1]))
+            return True
+        if len(parts) < 2 or not parts[0].isdigit():
+            return False
+        num, command = int(parts[0]), parts[1].upper()
+        if command == 'EXISTS':
+            self.exists = num
+        elif command == 'EXPUNGE':
+            if num <= len(self.uids):
+                self.unseen.discard(self.uids.pop(num - 1))
+            self.exists -= 1
+        elif command == 'FETCH' and len(parts) > 2:
+            self.fetched(num, parts[2])
+        else:
+            return False
+        return True
+
+    def fetched(self, seq, data):
+        # Handle '661 FETCH (FLAGS (\Flagged \Seen))', or the same with a
+        # UID for messages not yet known
+        match = self.UID_RE.search(data)
+        if seq <= len(self.uids):
+            uid = self.uids[seq - 1]
+        elif match and seq == len(self.uids) + 1:
+            uid = int(match.group(1))
+            self.uids.append(uid)
+            self.exists = max(self.exists, seq)
+        else:
+            return
+        self._flags(uid, data)
+
+    def _flags(self, uid, data):
+        match = self.FLAGS_RE.search(data)
+        if match:
+            if '\\seen' in match.group(1).lower().split():
+                self.unseen.discard(uid)
+            else:
+                self.unseen.add(uid)
+        match = self.MODSEQ_RE.search(data)
+        if match and self.modseq is not None:
+            self.modseq = max(self.modseq, int(match.group(1)))
+
+def _buffered(imap):
+    # Whether data has already been read from the socket, so that select()
+    # would not report it
+    rbuf = getattr(imap.file, '_rbuf', None)
+    if rbuf is not None and rbuf.tell():
+        return True
+    pending = getattr(imap.file, 'pending', None)
+    if pending and pending():
+        return True
+    sslobj = getattr(imap, 'sslobj', None)
+    return bool(sslobj and sslobj.pending())
+
+def seqset(nums):
+    # Compress numbers into an IMAP sequence set, e.g. '1:5,7'
+    ranges = []
+    for num in sorted(nums):
+        if ranges and ranges[-1][1] == num - 1:
+            ranges[-1][1] = num
+        else:
+            ranges.append([num, num])
+    return ','.join('%d' % (a,) if a == b else '%d:%d' % (a, b)
+                    for a, b in ranges)
+
+def parse_seqset(text):
+    # Expand a sequence set (without '*') into its numbers
+    for part in text.split(','):
+        if not part:
+            continue
+        a, _, b = part.partition(':')
+        a, b = int(a), int(b or a)
+        for num in xrange(min(a, b), max(a, b) + 1):
+            yield num
+
+def imap_esearch(imap, criteria, result='COUNT', uid=False):
+    # Search returning only the requested RFC 4731 result, e.g. COUNT, or
+    # ALL as a sequence set. Returns None if the server left it out.
+    args = ('SEARCH', 'RETURN', '(%s)' % (result,), criteria)
+    if uid:
+        args = ('UID',) + args
+    typ, dat = imap._simple_command(*args)
+    typ, dat = imap._untagged_response(typ, dat, 'ESEARCH')
+    assert typ == 'OK'
+    for data in reversed(dat):
+        match = data and re.search(r'\b%s (\S+)' % (result,), data)
+        if match:
+            return match.group(1)
+    return None
+
+STATUS_RE = re.compile(r'("(?:[^"\\]|\\.)*"|\S+) \((.*)\)$')
+
+def parse_status(data):
+    # Parse '"Lists/foo" (MESSAGES 3 UNSEEN 2)' from a STATUS response
+    match = STATUS_RE.match(data)
+    if not match:
+        return None, {}
+    name = match.group(1)
+    if name.startswith('"'):
+        name = re.sub(r'\\(.)', r'\1', name[1:-1])
+    items = match.group(2).split()
+    return name, dict((items[i].upper(), int(items[i+1]))
+                      for i in range(0, len(items) - 1, 2))
+
+def apply_status(folders, data, stale):
+    # Apply a NOTIFY STATUS response to the folders dict of unseen counts.
+    # Returns whether a count changed; folders whose count was left out are
+    # added to stale.
+    name, values = parse_status(data)
+    if name not in folders:
+        return False
+    if 'UNSEEN' not in values:
+        stale.add(name)
+        return False
+    if folders[name] == values['UNSEEN']:
+        return False
+    folders[name] = values['UNSEEN']
+    return True
+
+def imap_status(imap, mailboxes, items='(UNSEEN)'):
+    # STATUS several mailboxes, sending all commands before reading any
+    # responses so that it takes a single round trip
+    tags = []
+    for name in mailboxes:
+        tag = imap._new_tag()
+        imap.send('%s STATUS %s %s%s' % (tag, imap._checkquote(name), items,
+                                         imaplib.CRLF))
+        tags.append(tag)
+    for tag in tags:
+        imap._get_tagged_response(tag)
+    results = {}
+    for data in imap.untagged_responses.pop('STATUS', []):
+        if isinstance(data, tuple):
+            continue    # Mailbox names sent as literals are not supported
+        name, values = parse_status(data)
+        results[name] = values
+    return results
+
+def imap_idle(imap, timeout=29*60, mailbox=None, folders=None, stale=None):
     # Wait for something to happen
     #
     # See: http://stackoverflow.com/questions/18103278/
     # See also: http://bugs.python.org/file27400/imapidle.patch
+    #
+    # This is a generator yielding Wait objects, so that the IDLE wait can
+    # be run either in a CheckerThread or on the shared event loop. If a
+    # MailboxState is given, untagged responses are applied to it, and a new
+    # count is yielded whenever it changes; IDLE ends once new messages need
+    # to be fetched.
+    #
+    # Likewise, NOTIFY STATUS responses update the folders dict of unseen
+    # counts; folders whose count was left out are added to stale.
     tag = imap._new_tag()
     try:
         imap.send('%s IDLE%s' % (tag, imaplib.CRLF))
+        imap.recorder.record('idle', 'enter')
         sock = imap.socket()
         deadline = time.time() + timeout
         while True:
-            timeleft = deadline - time.time()
-            if timeleft <= 0:
-                break
-            #print "Waiting on IDLE (%d sec left)" % (timeleft,)
-            ready = select.select((sock,), (), (sock,), timeleft)
-            if sock not in ready[0]:
-                break
+            if not _buffered(imap):
+                timeleft = deadline - time.time()
+                if timeleft <= 0:
+                    break
+                #print "Waiting on IDLE (%d sec left)" % (timeleft,)
+                wait = Wait(timeleft, sock)
+                yield wait
+                if not wait.ready:
+                    break
             # Something happened
             resp = imap.readline().strip()
             #print "Got %s from IMAP" % (resp,)
@@ -43,17 +444,49 @@ def imap_idle(imap, timeout=29*60):
                     command = resp[1:].strip().split(None, 1)[0].upper()
                     if command in ('OK',):
                         continue
-                    # Handle '* 661 FETCH (FLAGS (\Flagged \Seen))'
-                    # Handle '* 664 EXISTS'
-                    # Handle '* 664 EXPUNGE'
-                    # (but will need to track all messages in mailbox)
+                    if mailbox:
+                        count = mailbox.count
+                        if mailbox.update(resp[1:].strip()):
+                            if mailbox.missing:
+                                break
+                            if mailbox.count != count:
+                                yield mailbox.count
+                            continue
+                    if folders is not None and command == 'STATUS':
+                        if apply_status(folders,
+                                        resp[1:].strip().split(None, 1)[1],
+                                        stale):
+                            yield mailbox.count if mailbox else None
+                        elif stale:
+                            break
+                        continue
                 break
             elif resp[0] != '+':
                 raise Exception("Unexpected IMAP IDLE response: %s" %
                                 (resp,))
     finally:
-        imap.send('DONE%s' % (imaplib.CRLF))
-        imap._get_response()
+        imap.recorder.record('idle', 'exit')
+        # Once the connection has been aborted, there is no ending IDLE
+        if not imap.aborted:
+            imap.send('DONE%s' % (imaplib.CRLF))
+            # Read up to the tagged response, keeping track of any changes
+            while True:
+                resp = imap.readline()
+                if not resp:
+                    raise imap.abort('socket error: EOF')
+                resp = resp.strip()
+                if resp.startswith(tag + ' '):
+                    break
+                if not resp.startswith('*'):
+                    continue
+                data = resp[1:].strip()
+                if folders is not None and \
+                   data.split(None, 1)[0].upper() == 'STATUS':
+                    # Reported with the next count
+                    apply_status(folders, data.split(None, 1)[1], stale)
+                elif mailbox:
+                    mailbox.update(data)
+        imap.tagged_commands.pop(tag, None)
 
 class AccountIMAP(Account):
     def __init__(self, config, icon):
@@ -67,56 +500,327 @@ class AccountIMAP(Account):
         self.mailbox = config.get('mailbox', 'INBOX')
         self.password = '%s@%s' % (self.username, self.hostname)
 
+        # Other mailboxes to watch over the same connection; the first
+        # mailbox is the one selected
+        mailboxes = [x.strip() for x in config.get('mailboxes', '').split(',')
+                     if x.strip()]
+        if mailboxes:
+            self.mailbox = mailboxes[0]
+        self._folders = OrderedDict((x, '?') for x in mailboxes[1:]
+                                    if x != self.mailbox)
+        self._notify = False
+
         # Persistent IMAP connection
         self._imap = None
-        self._refcount = 0
+        self._qresync = False
+
+        # Mailbox state, saved between connections for RFC 7162
+        self._state = MailboxState()
+        self._cache = configmgr.cache_file('imap', urllib.quote(
+            '%s@%s:%d' % (self.username, self.hostname, self.port), '@:'),
+            urllib.quote(self.mailbox, ''))
+        try:
+            self._state.load(self._cache)
+        except (IOError, ValueError, KeyError):
+            pass
 
     @contextmanager
     def _connect(self):
-        if not self._imap:
-            try:
-                self._imap = IMAP4_VerifiedSSL(self.hostname, self.port)
-                self._imap.login(self.username, self.password)
-                self._imap.select(self.mailbox, True)
-                #print "IMAP Connected"
-            except Exception:
-                if self._imap:
-                    self._imap.logout()
-                #print "IMAP Failed"
-                self._imap = None
-                raise
+        imap = self._imap
+        if not imap:
+            with self.app.scheduler.connecting(self.hostname):
+                try:
+                    # Connecting and the TLS handshake have socket timeouts
+                    # of their own
+                    with self.phase('greeting', self.TIMEOUTS['connect'] +
+                                    self.TIMEOUTS['tls']):
+                        imap = IMAP4_VerifiedSSL(self.hostname, self.port,
+                                                 timeouts=self.TIMEOUTS,
+                                                 metrics=self.metrics,
+                                                 recorder=self.recorder,
+                                                 opening=self._opening)
+                except Exception:
+                    self._imap = None
+                    raise
+                try:
+                    with self.phase('login'):
+                        imap.login(self.username, self.password)
+                        if 'COMPRESS=DEFLATE' in imap.capabilities:
+                            imap.compress()
+                    with self.phase('select'):
+                        self._select(imap)
+                    #print "IMAP Connected"
+                except Exception:
+                    self._disconnect(imap)
+                    #print "IMAP Failed"
+                    raise
         # Return reference to IMAP object
-        self._refcount += 1     # FIXME: thread-safe?
+        imap.refcount += 1      # FIXME: thread-safe?
         try:
-            yield self._imap
+            yield imap
         finally:
-            self._refcount -= 1
+            imap.refcount -= 1
             # Log out of the IMAP server
-            assert self._refcount >= 0
-            if self._refcount == 0 and self._imap:
-                self._imap.logout()
-                self._imap = None
+            assert imap.refcount >= 0
+            if imap.refcount == 0:
+                self._disconnect(imap)
                 #print "IMAP Disconnected"
 
+    def _opening(self, imap):
+        # Let abort_io() reach the connection while it is being set up
+        self._imap = imap
+
+    def _disconnect(self, imap):
+        if self._imap is imap:
+            self._imap = None
+        if imap.aborted:
+            imap.shutdown()
+        else:
+            with self.phase('logout'):
+                imap.logout()
+
+    def abort_io(self):
+        # The next check will connect afresh
+        imap, self._imap = self._imap, None
+        if imap:
+            imap.abort_io()
+
+    def _select(self, imap):
+        # Like imap.select(self.mailbox, True), but asking for the changes
+        # since the saved state where the server supports RFC 7162
+        self._qresync = False
+        params = self._examine_params(imap)
+        imap.untagged_responses = {}
+        imap.is_readonly = True
+        imap.recorder.record('select', self.mailbox)
+        typ, dat = imap._simple_command('EXAMINE', self.mailbox, params)
+        if typ != 'OK':
+            imap.state = 'AUTH'
+            raise imap.error('EXAMINE %s failed: %s' % (self.mailbox, dat))
+        imap.state = 'SELECTED'
+
+    def _examine_params(self, imap):
+        # The EXAMINE parameters for resynchronising self._state
+        state = self._state
+        if 'QRESYNC' in imap.capabilities:
+            imap._simple_command('ENABLE', 'QRESYNC')
+            if state.modseq and state.uidvalidity:
+                self._qresync = True
+                return '(QRESYNC (%d %d))' % (state.uidvalidity, state.modseq)
+            return '(CONDSTORE)'
+        elif 'CONDSTORE' in imap.capabilities:
+            return '(CONDSTORE)'
+        return None
+
+    def _resync(self, imap):
+        # Bring the mailbox state up to date after selecting the mailbox
+        state = self._state
+        responses = imap.untagged_responses
+        uidvalidity = int(responses.pop('UIDVALIDITY', ['0'])[-1])
+        modseq = responses.pop('HIGHESTMODSEQ', None)
+        modseq = int(modseq[-1]) if modseq else None
+        exists = int(responses.pop('EXISTS', ['0'])[-1])
+        changes = [x for x in responses.pop('FETCH', []) if x]
+        vanished = set()
+        for data in responses.pop('VANISHED', []):
+            vanished.update(parse_seqset(data.split()[-1]))
+        if not modseq or not state.modseq or \
+           uidvalidity != state.uidvalidity:
+            self.log.debug("Rescanning mailbox")
+            state.modseq = None
+            self._rescan(imap)
+        elif modseq == state.modseq and exists == len(state.uids):
+            self.log.debug("Mailbox unchanged since MODSEQ %d" % (modseq,))
+        elif self._qresync:
+            self.log.debug("Resynchronising from MODSEQ %d with QRESYNC" %
+                           (state.modseq,))
+            self._refresh(imap, exists, changes, vanished)
+        else:
+            self.log.debug("Resynchronising from MODSEQ %d with CONDSTORE" %
+                           (state.modseq,))
+            self._refresh(imap, exists)
+        state.uidvalidity = uidvalidity
+        state.modseq = modseq
+        self._save()
+
+    def _refresh(self, imap, exists=None, changes=None, vanished=()):
+        # Apply changes since state.modseq; without QRESYNC, expunged
+        # messages are found by listing the mailbox's UIDs again
+        state = self._state
+        if changes is None:
+            typ, changes = imap.uid('FETCH', '1:*', '(UID FLAGS)',
+                                    '(CHANGEDSINCE %d)' % (state.modseq,))
+            assert typ == 'OK'
+            changes = [x[0] if isinstance(x, tuple) else x
+                       for x in changes if x]
+        state.merge(vanished, changes)
+        if exists is None or len(state.uids) != exists:
+            state.set_uids(self._uid_search(imap, 'ALL'))
+        for response in ('EXISTS', 'EXPUNGE', 'VANISHED', 'FETCH'):
+            imap.untagged_responses.pop(response, None)
+
+    def _save(self):
+        if self._state.modseq is None:
+            return      # Nothing to resynchronise from
+        try:
+            self._state.save(self._cache)
+        except (IOError, OSError):
+            self.log.exception("Unable to save mailbox state")
+
+    def _rescan(self, imap):
+        # Rebuild the mailbox state from scratch
+        uids = self._uid_search(imap, 'ALL')
+        unseen = self._uid_search(imap, 'UNSEEN')
+        for response in ('EXISTS', 'EXPUNGE', 'VANISHED', 'FETCH'):
+            imap.untagged_responses.pop(response, None)
+        self._state.reset(uids, unseen)
+
+    def _uid_search(self, imap, criteria):
+        # With ESEARCH, the UIDs come back as a compact sequence set
+        if 'ESEARCH' in imap.capabilities:
+            return list(parse_seqset(imap_esearch(imap, criteria, 'ALL',
+                                                  uid=True) or ''))
+        typ, uids = imap.uid('SEARCH', criteria)
+        assert typ == 'OK'
+        return [int(x) for x in uids[0].split()]
+
+    def _absorb(self, imap):
+        # Apply untagged responses imaplib collected while running other
+        # commands. Returns False if the state can no longer be trusted.
+        if imap.untagged_responses.pop('EXPUNGE', None) or \
+           imap.untagged_responses.pop('VANISHED', None):
+            return False    # Order relative to EXISTS and FETCH was lost
+        exists = imap.untagged_responses.pop('EXISTS', None)
+        if exists:
+            self._state.exists = int(exists[-1])
+        return True
+
+    def _fetch_new(self, imap):
+        # Fetch the UIDs and flags of new messages. Returns False if a full
+        # resync is needed instead.
+        if not self._absorb(imap):
+            return False
+        missing = self._state.missing
+        if missing:
+            typ, data = imap.fetch('%d:%d' % missing, '(UID FLAGS)')
+            if typ != 'OK':
+                return False
+            for item in data:
+                if isinstance(item, tuple):
+                    item = item[0]
+                if item:
+                    seq, rest = item.split(None, 1)
+                    self._state.fetched(int(seq), rest)
+            if not self._absorb(imap) or self._state.missing:
+                return False
+        return True
+
+    def _result(self, count):
+        # The count, or the count of each mailbox if watching several
+        if not self._folders:
+            return count
+        counts = OrderedDict([(self.mailbox, count)])
+        counts.update(self._folders)
+        return counts
+
+    def _status(self, imap, names=None):
+        # Refresh the counts of the other mailboxes
+        names = list(self._folders if names is None else names)
+        if not names:
+            return
+        results = imap_status(imap, names)
+        for name in names:
+            self._folders[name] = results.get(name, {}).get('UNSEEN', '?')
+        # NOTIFY may have sent the other mailboxes' counts meanwhile
+        for name, values in results.items():
+            if name in self._folders and name not in names and \
+               'UNSEEN' in values:
+                self._folders[name] = values['UNSEEN']
+
+    def _absorb_status(self, imap, stale):
+        # Apply the NOTIFY STATUS responses imaplib collected while running
+        # other commands
+        for data in imap.untagged_responses.pop('STATUS', []):
+            if not isinstance(data, tuple):
+                apply_status(self._folders, data, stale)
+
+    def _start_notify(self, imap):
+        # Ask for STATUS responses about the other mailboxes (RFC 5465)
+        self._notify = False
+        if not self._folders or 'NOTIFY' not in imap.capabilities:
+            return
+        events = '(MessageNew MessageExpunge FlagChange)'
+        names = ' '.join(imap._checkquote(x) for x in self._folders)
+        typ, dat = imap._simple_command(
+            'NOTIFY', 'SET', '(SELECTED %s)' % (events,),
+            '(MAILBOXES (%s) %s)' % (names, events))
+        self._notify = typ == 'OK'
+
     def watch(self):
         # Reuse a single connection to the server
         with self._connect() as imap:
+            if 'IDLE' not in imap.capabilities:
+                while True:
+                    yield self.check()
+                    yield Wait(self.app.scheduler.poll_delay(self))
+            # Track the mailbox's messages from IDLE responses, and the
+            # other mailboxes' counts from NOTIFY or STATUS
+            with self.phase('select'):
+                self._resync(imap)
+                self._start_notify(imap)
+                self._status(imap)
+            woke = None     # When IDLE last woke up for a server push
             while True:
-                yield self.check()
-                if 'IDLE' in imap.capabilities:
-                    # Use check interval or 29 minutes
-                    imap_idle(imap, timeout=self.interval)
-                else:
-                    time.sleep(self.interval)
+                if woke:
+                    self.metrics.observe('idle_wake', time.time() - woke)
+                yield self._result(self._state.count)
+                # Use check interval or 29 minutes
+                stale = set()
+                woke = None
+                with self.phase('idle', self.interval):
+                    for item in imap_idle(imap, timeout=self.interval,
+                                          mailbox=self._state,
+                                          folders=self._folders, stale=stale):
+                        if isinstance(item, Wait):
+                            yield item
+                            woke = time.time() if item.ready else None
+                            continue
+                        if woke:
+                            self.metrics.observe('idle_wake',
+                                                 time.time() - woke)
+                            woke = None
+                        yield self._result(item)
+                with self.phase('search'):
+                    if not self._fetch_new(imap):
+                        if self._state.modseq:
+                            self._refresh(imap)
+                        else:
+                            self._rescan(imap)
+                    if not self._notify:
+                        self._status(imap)
+                    else:
+                        self._absorb_status(imap, stale)
+                        if stale:
+                            self._status(imap, stale)
+                self._save()
+
+    def cache_state(self):
+        return {'uidvalidity': self._state.uidvalidity}
+
+    def cache_files(self):
+        return [self._cache]
 
     def check(self):
-        with self._connect() as imap:
-            #results = imap.status(self.mailbox, '(UNSEEN)')
-            #result = results[1][0].split('(')[1].split(')')[0].split(' ')
-            #result = int(result[1])
-            typ, msgnums = imap.search(None, '(UNSEEN)')
-            assert typ == 'OK'
-            result = len(msgnums[0].split())
-        return result
+        with self._connect() as imap, self.phase('search'):
+            # STATUS (UNSEEN) would also return just the count, but RFC 3501
+            # discourages using it on the selected mailbox
+            if 'ESEARCH' in imap.capabilities:
+                result = int(imap_esearch(imap, 'UNSEEN') or 0)
+            else:
+                typ, msgnums = imap.search(None, '(UNSEEN)')
+                assert typ == 'OK'
+                result = len(msgnums[0].split())
+            self._status(imap)
+        return self._result(result)
 
 Account = AccountIMAP
@@ -0,0 +1,421 @@
+from .. import sslutils
+from ..metrics import CountingSocket
+from . import Account, Wait
+
+import httplib, socket
+import urlparse, base64
+import json
+import time
+from collections import OrderedDict
+
+# JMAP (RFC 8620) for mail (RFC 8621). Counts are the unreadEmails of
+# Mailbox/get, asked for again only when the server's EventSource push
+# channel says that the account's Mailbox state changed.
+
+CORE = 'urn:ietf:params:jmap:core'
+MAIL = 'urn:ietf:params:jmap:mail'
+
+class JMAPError(Exception):
+    pass
+
+class Redirect(httplib.HTTPException):
+    """A response sending the request to another URL."""
+    def __init__(self, message, location):
+        httplib.HTTPException.__init__(self, message)
+        self.location = location
+
+class Session(object):
+    """The parts of a JMAP session resource multiowl uses."""
+    def __init__(self, url, data):
+        self.api_url = urlparse.urljoin(url, data['apiUrl'])
+        self.event_source_url = data.get('eventSourceUrl')
+        if self.event_source_url:
+            self.event_source_url = urlparse.urljoin(url,
+                                                     self.event_source_url)
+        self.account_id = data['primaryAccounts'][MAIL]
+        self.state = data.get('state')
+
+    def event_source(self, types, closeafter, ping):
+        # The URL is a level 1 URI template (RFC 6570)
+        url = self.event_source_url
+        for name, value in (('types', types), ('closeafter', closeafter),
+                            ('ping', str(ping))):
+            url = url.replace('{%s}' % (name,), value)
+        return url
+
+def mailbox_paths(mailboxes):
+    # Each mailbox's name, prefixed with those of its parents, e.g.
+    # Lists/foo, by mailbox id
+    byid = dict((mailbox['id'], mailbox) for mailbox in mailboxes)
+    paths = {}
+    def path(mailbox, depth=0):
+        if mailbox['id'] not in paths:
+            parent = byid.get(mailbox.get('parentId'))
+            if parent and depth < len(byid):
+                paths[mailbox['id']] = '%s/%s' % (path(parent, depth + 1),
+                                                  mailbox['name'])
+            else:
+                paths[mailbox['id']] = mailbox['name']
+        return paths[mailbox['id']]
+    for mailbox in mailboxes:
+        path(mailbox)
+    return paths
+
+class EventStream(object):
+    """An EventSource (text/event-stream) response, read from its socket as
+    data arrives so that select() on the socket can wait for events. Events
+    are collected as (type, data) in events."""
+
+    BLOCKSIZE = 16384
+
+    def __init__(self, sock, metrics):
+        self.sock = sock
+        self.metrics = metrics
+        self.status = None
+        self.chunked = False
+        self.buf = ''       # Received, not yet decoded
+        self.text = ''      # Decoded, not yet parsed into events
+        self.chunk = 0      # Bytes left of the current chunk
+        self.skip = 0       # Bytes of the CRLF after a chunk left to skip
+        self.fields = {}    # Of the event being parsed
+        self.events = []
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        # Read what has arrived; blocks if nothing has
+        data = self.sock.recv(self.BLOCKSIZE)
+        # Decrypted data waiting in the SSL object would not wake select()
+        while data and getattr(self.sock, 'pending', lambda: 0)():
+            data += self.sock.recv(self.BLOCKSIZE)
+        if not data:
+            raise httplib.HTTPException("The push channel was closed")
+        self.metrics.transferred(bytes_in=len(data))
+        self.buf += data
+        if self.status is None and not self._begin():
+            return
+        self._decode()
+        self._parse()
+
+    def _begin(self):
+        # Parse the response header, once all of it has arrived
+        end = self.buf.find('\r\n\r\n')
+        if end == -1:
+            return False
+        lines = self.buf[:end].split('\r\n')
+        self.buf = self.buf[end + 4:]
+        version, status, reason = (lines[0].split(None, 2) + [''])[:3]
+        self.status = int(status)
+        headers = dict((name.strip().lower(), value.strip())
+                       for name, _, value
+                       in (line.partition(':') for line in lines[1:]))
+        if self.status != httplib.OK:
+            raise httplib.HTTPException("EventSource: %d %s" %
+                                        (self.status, reason))
+        self.chunked = headers.get('transfer-encoding', '').lower() == \
+            'chunked'
+        return True
+
+    def _decode(self):
+        if not self.chunked:
+            self.text += self.buf
+            self.buf = ''
+            return
+        while True:
+            if self.skip:
+                skipped = min(self.skip, len(self.buf))
+                self.buf = self.buf[skipped:]
+                self.skip -= skipped
+                if self.skip:
+                    return
+            if not self.chunk:
+                end = self.buf.find('\r\n')
+                if end == -1:
+                    return
+                size = int(self.buf[:end].split(';', 1)[0], 16)
+                self.buf = self.buf[end + 2:]
+                if not size:
+                    raise httplib.HTTPException("The push channel ended")
+                self.chunk = size
+            data = self.buf[:self.chunk]
+            if not data:
+                return
+            self.buf = self.buf[len(data):]
+            self.chunk -= len(data)
+            self.text += data
+            if not self.chunk:
+                self.skip = 2
+
+    def _parse(self):
+        # See https://html.spec.whatwg.org/multipage/server-sent-events.html
+        lines = self.text.split('\n')
+        self.text = lines.pop()     # Incomplete
+        for line in lines:
+            line = line.rstrip('\r')
+            if not line:
+                if 'data' in self.fields:
+                    self.events.append((self.fields.get('event', 'message'),
+                                        self.fields['data']))
+                self.fields = {}
+            elif not line.startswith(':'):
+                name, _, value = line.partition(':')
+                if value.startswith(' '):
+                    value = value[1:]
+                if name == 'data' and 'data' in self.fields:
+                    self.fields['data'] += '\n' + value
+                elif name in ('event', 'data'):
+                    self.fields[name] = value
+
+    def take(self):
+        events, self.events = self.events, []
+        return events
+
+class AccountJMAP(Account):
+    # Seconds between the pings the push channel is asked for; it is taken
+    # to be dead after two are missed
+    PING = 60
+    # Redirects followed to the session resource, e.g. from .well-known
+    REDIRECTS = 5
+    PROPERTIES = ['name', 'parentId', 'role', 'unreadEmails']
+
+    def __init__(self, config, icon):
+        super(AccountJMAP, self).__init__(config, icon)
+
+        # The session resource, found by default at its well-known URL
+        self.url = config.get('url') or \
+            'https://%s/.well-known/jmap' % (config['server'],)
+        self.hostname = urlparse.urlsplit(self.url).hostname
+        self.username = config['username']
+        self.password = '%s@%s' % (self.username, self.hostname)
+        # Mailboxes to watch by name, e.g. Lists/foo; by default the inbox
+        self.mailboxes = [x.strip() for x in
+                          config.get('mailboxes', '').split(',') if x.strip()]
+
+        self._session = None
+        self._state = None      # Of the mailboxes, as of the last count
+        self._ping = self.PING
+        # Persistent HTTPS connection for API requests, and the push channel
+        self._conn = None
+        self._stream = None
+
+    def _connect(self, url):
+        parts = urlparse.urlsplit(url)
+        with self.app.scheduler.connecting(parts.hostname):
+            # Socket timeout for connecting and the TLS handshake
+            conn = sslutils.VerifiedHTTPSConnection(
+                parts.hostname, parts.port, timeout=self.TIMEOUTS['connect'])
+            self.recorder.record('connect', parts.netloc)
+            conn.connect()
+            self.metrics.observe('connect', conn.connect_time)
+            self.metrics.observe('tls', conn.tls_time)
+        conn.sock.settimeout(self.TIMEOUTS['io'])
+        return conn
+
+    def _close(self, conn):
+        if self._conn is conn:
+            self._conn = None
+        conn.close()
+
+    def abort_io(self):
+        # The next check will connect afresh
+        conn, self._conn = self._conn, None
+        stream, self._stream = self._stream, None
+        for sock in (conn and conn.sock, stream and stream.sock):
+            if sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def _http_request(self, method, url, accept, body=''):
+        parts = urlparse.urlsplit(url)
+        auth = base64.b64encode('%s:%s' % (self.username, self.password))
+        request = ['%s %s HTTP/1.1' % (method, parts.path +
+                                       ('?' + parts.query if parts.query
+                                        else '')),
+                   'Host: %s' % (parts.netloc,),
+                   'Authorization: Basic %s' % (auth,),
+                   'Accept: %s' % (accept,),
+                   'Accept-Encoding: identity']
+        if method == 'POST':
+            request.extend(['Content-Type: application/json',
+                            'Content-Length: %d' % (len(body),)])
+        return '\r\n'.join(request) + '\r\n\r\n' + body
+
+    def _request(self, url, body=None):
+        # GET url, or POST body to it as JSON, over the persistent
+        # connection (if it is to the same server); returns the response
+        parts = urlparse.urlsplit(url)
+        conn = self._conn
+        if conn and (conn.host, conn.port) != (parts.hostname, parts.port or
+                                               httplib.HTTPS_PORT):
+            self._close(conn)
+            conn = None
+        reused = conn is not None
+        if not reused:
+            conn = self._conn = self._connect(url)
+        method = 'GET' if body is None else 'POST'
+        sock = CountingSocket(conn.sock, self.metrics)
+        try:
+            sock.sendall(self._http_request(method, url, 'application/json',
+                                            '' if body is None
+                                            else json.dumps(body)))
+            response = httplib.HTTPResponse(sock, method=method)
+            response.begin()
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            self._close(conn)
+            if reused:
+                # The server may have closed the idle connection; retry
+                # once on a new one
+                return self._request(url, body)
+            raise
+        self.recorder.record('response', '%d %s %s' % (response.status,
+                                                       method, parts.path))
+        if response.will_close:
+            self._close(conn)
+        location = response.getheader('location')
+        if response.status in (httplib.MOVED_PERMANENTLY, httplib.FOUND,
+                               httplib.TEMPORARY_REDIRECT, 308) and location:
+            raise Redirect("%s: %d %s" % (parts.path, response.status,
+                                          response.reason), location)
+        if response.status != httplib.OK:
+            raise httplib.HTTPException("%s: %d %s" % (parts.path,
+                                                       response.status,
+                                                       response.reason))
+        return json.loads(data)
+
+    def _get_session(self):
+        # Relative URLs in the session are resolved against where it was
+        # found in the end
+        url = self.url
+        with self.phase('login'):
+            for hop in range(self.REDIRECTS + 1):
+                try:
+                    data = self._request(url)
+                    break
+                except Redirect as e:
+                    url = urlparse.urljoin(url, e.location)
+                    if urlparse.urlsplit(url).scheme != 'https':
+                        raise httplib.HTTPException("%s: redirected to %s" %
+                                                    (e, url))
+            else:
+                raise httplib.HTTPException("%s: too many redirects" %
+                                            (self.url,))
+            self._session = Session(url, data)
+        return self._session
+
+    def _mailbox_get(self):
+        # Returns the count, and the state it is as of
+        session = self._session or self._get_session()
+        with self.phase('fetch'):
+            response = self._request(session.api_url, {
+                'using': [CORE, MAIL],
+                'methodCalls': [['Mailbox/get', {
+                    'accountId': session.account_id, 'ids': None,
+                    'properties': self.PROPERTIES}, '0']]})
+        name, result, tag = response['methodResponses'][0]
+        if name == 'error':
+            raise JMAPError("Mailbox/get: %s" % (result.get('type'),))
+        if response.get('sessionState') != session.state:
+            self._session = None    # Look it up again next time
+        mailboxes = result['list']
+        if not self.mailboxes:
+            inbox = [x for x in mailboxes if x.get('role') == 'inbox']
+            if not inbox:
+                raise JMAPError("No inbox")
+            return inbox[0]['unreadEmails'], result['state']
+        paths = mailbox_paths(mailboxes)
+        unread = dict((paths[x['id']], x['unreadEmails']) for x in mailboxes)
+        return OrderedDict((name, unread.get(name, '?'))
+                           for name in self.mailboxes), result['state']
+
+    def _open_stream(self, session):
+        # Ask only for Mailbox changes, and for pings to tell that the
+        # channel is alive
+        url = session.event_source('Mailbox', 'no', self.PING)
+        conn = self._connect(url)
+        stream = EventStream(conn.sock, self.metrics)
+        self._stream = stream
+        try:
+            data = self._http_request('GET', url, 'text/event-stream')
+            conn.sock.sendall(data)
+            self.metrics.transferred(bytes_out=len(data))
+            # Wait until the server has answered, so that no change after
+            # counting can be missed
+            with self.phase('connect'):
+                while stream.status is None:
+                    stream.read()
+        except Exception:
+            self._close_stream(stream)
+            raise
+        self.recorder.record('push', 'listening')
+        return stream
+
+    def _close_stream(self, stream):
+        if self._stream is stream:
+            self._stream = None
+        try:
+            stream.sock.close()
+        except socket.error:
+            pass
+
+    def _changed(self, events, session):
+        # Whether the events say that the mailboxes changed since counting
+        changed = False
+        for event, data in events:
+            if event == 'ping':
+                try:
+                    self._ping = max(int(json.loads(data)['interval']), 1)
+                except (ValueError, KeyError, TypeError):
+                    pass
+                continue
+            if event != 'state':
+                continue
+            self.recorder.record('push', data)
+            states = json.loads(data).get('changed', {}) \
+                                     .get(session.account_id, {})
+            if states.get('Mailbox', self._state) != self._state:
+                changed = True
+        return changed
+
+    def watch(self):
+        session = self._get_session()
+        if not session.event_source_url:
+            while True:
+                yield self.check()
+                yield Wait(self.app.scheduler.poll_delay(self))
+        stream = self._open_stream(session)
+        try:
+            self._ping = self.PING
+            count, self._state = self._mailbox_get()
+            while True:
+                yield count
+                reported = time.time()
+                woke = None
+                while True:
+                    if not stream.events:
+                        wait = Wait(self._ping * 2, stream)
+                        yield wait
+                        if not wait.ready:
+                            raise socket.timeout("No ping from %s" %
+                                                 (self.hostname,))
+                        woke = time.time()
+                        stream.read()
+                    if self._changed(stream.take(), session):
+                        count, self._state = self._mailbox_get()
+                        if woke:
+                            self.metrics.observe('push_wake',
+                                                 time.time() - woke)
+                        break
+                    if time.time() - reported >= self.interval:
+                        break   # Report it again, as a sign of life
+        finally:
+            self._close_stream(stream)
+
+    def check(self):
+        count, self._state = self._mailbox_get()
+        return count
+
+Account = AccountJMAP
@@ -0,0 +1,139 @@
+from . import Account, Wait
+from .. import inotify
+
+import os
+import errno
+import threading
+
+# Messages in new/ are unread; those in cur/ are unless their info (after
+# ':2,') has the S (seen) flag, or the T (trashed) flag of a message that is
+# only waiting to be expunged. See http://cr.yp.to/proto/maildir.html
+
+SUBDIRS = ('new', 'cur')
+
+def unread(subdir, name):
+    if name.startswith('.'):
+        return False
+    if subdir == 'new':
+        return True
+    info = name.rpartition(':2,')[2] if ':2,' in name else ''
+    return 'S' not in info and 'T' not in info
+
+class MaildirIndex(object):
+    """The names of the unread messages in a Maildir, by subdirectory.
+
+    Only unread messages are kept, so that a folder with 100k read messages
+    costs nothing after the first scan; delivery, reading a message and
+    expunging all show up as renames, creations and deletions to apply."""
+
+    def __init__(self, path):
+        self.path = path
+        self.unread = dict((subdir, set()) for subdir in SUBDIRS)
+
+    @property
+    def count(self):
+        return sum(len(names) for names in self.unread.values())
+
+    def scan(self):
+        for subdir in SUBDIRS:
+            self.unread[subdir] = set(
+                name for name in os.listdir(os.path.join(self.path, subdir))
+                if unread(subdir, name))
+
+    def added(self, subdir, name):
+        if unread(subdir, name):
+            self.unread[subdir].add(name)
+
+    def removed(self, subdir, name):
+        self.unread[subdir].discard(name)
+
+class AccountMaildir(Account):
+    MASK = inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | \
+        inotify.IN_DELETE | inotify.IN_ONLYDIR
+
+    def __init__(self, config, icon):
+        super(AccountMaildir, self).__init__(config, icon)
+        self.path = os.path.expanduser(config['path'])
+        self._index = MaildirIndex(self.path)
+        self._inotify = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # Watch before scanning, so that nothing happening during the scan
+        # is missed; applying its events afterwards is harmless
+        watch = inotify.Inotify()
+        try:
+            for subdir in SUBDIRS:
+                watch.add_watch(os.path.join(self.path, subdir), self.MASK)
+            self.recorder.record('scan', self.path)
+            self._index.scan()
+        except Exception:
+            watch.close()
+            raise
+        with self._lock:
+            self._inotify = watch
+        return watch
+
+    def _close(self, watch):
+        with self._lock:
+            if self._inotify is watch:
+                self._inotify = None
+        watch.close()
+
+    def abort_io(self):
+        with self._lock:
+            watch, self._inotify = self._inotify, None
+        if watch:
+            self.recorder.record('abort')
+            watch.abort()
+
+    def _apply(self, events):
+        # Returns False if events were lost, so that a rescan is needed
+        index = self._index
+        for path, mask, cookie, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                self.recorder.record('rescan', 'events lost')
+                return False
+            if mask & inotify.IN_IGNORED:
+                # The subdirectory went away; start over once it is back
+                raise IOError(errno.ENOENT, "Stopped watching %s" % (path,))
+            subdir = os.path.basename(path)
+            if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                index.added(subdir, name)
+            elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                index.removed(subdir, name)
+        return True
+
+    def watch(self):
+        if not inotify.available():
+            return super(AccountMaildir, self).watch()
+        return self._watch_inotify()
+
+    def _watch_inotify(self):
+        watch = self._open()
+        try:
+            count = None
+            while True:
+                if self._index.count != count:
+                    count = self._index.count
+                    yield count
+                wait = Wait(self.interval, watch)
+                yield wait
+                if not wait.ready:
+                    count = None    # Report it again, as a sign of life
+                    continue
+                events = watch.read()
+                if not events:
+                    raise IOError(errno.EIO, "Stopped watching %s" %
+                                  (self.path,))
+                if not self._apply(events):
+                    self._index.scan()
+        finally:
+            self._close(watch)
+
+    def check(self):
+        index = MaildirIndex(self.path)
+        index.scan()
+        return index.count
+
+Account = AccountMaildir
@@ -0,0 +1,245 @@
+from . import Account, Wait
+from .. import config as configmgr
+from .. import inotify
+
+import os
+import errno
+import array, mmap, zlib
+import json, urllib
+import threading
+
+class MboxIndex(object):
+    """Where each message of an mbox starts, and whether it is unread (has
+    no R in its Status: header), as of when the file was size bytes long.
+
+    Mail is delivered by appending to the file, so as long as the file only
+    grew, only the last message known (which may have been incomplete) and
+    those after it are parsed again. Anything else, i.e. the file shrinking,
+    being rewritten in place, or its head or the start of its last message
+    changing, means a full rescan."""
+
+    VERSION = 1
+    HEAD = 4096     # Bytes at the start of the file that are checksummed
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.size = 0
+        self.mtime = None
+        self.head = None        # CRC of the first HEAD bytes
+        self.anchor = None      # CRC of the last message's From line
+        self.offsets = array.array('L')
+        self.unread = array.array('B')
+        self.count = 0
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            data = json.loads(f.readline())
+            if data['version'] != self.VERSION:
+                raise ValueError("Unknown mbox index version")
+            offsets = array.array('L')
+            unread = array.array('B')
+            offsets.fromfile(f, data['messages'])
+            unread.fromfile(f, data['messages'])
+        self.size = data['size']
+        self.mtime = data['mtime']
+        self.head = data['head']
+        self.anchor = data['anchor']
+        self.offsets = offsets
+        self.unread = unread
+        self.count = data['count']
+
+    def save(self, path):
+        data = {'version': self.VERSION, 'size': self.size,
+                'mtime': self.mtime, 'head': self.head,
+                'anchor': self.anchor, 'count': self.count,
+                'messages': len(self.offsets)}
+        # Replace atomically
+        with open(path + '.tmp', 'wb') as f:
+            f.write(json.dumps(data) + '\n')
+            self.offsets.tofile(f)
+            self.unread.tofile(f)
+        os.rename(path + '.tmp', path)
+
+    def update(self, path):
+        # Returns 'unchanged', 'appended' or 'rescanned'
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            st = None       # No mail has been delivered yet
+        if st and st.st_size == self.size and st.st_mtime == self.mtime:
+            return 'unchanged'
+        if not st and not self.size and not self.offsets:
+            return 'unchanged'  # Still no mail
+        if not st or not st.st_size:
+            self.reset()
+            self.mtime = st and st.st_mtime
+            return 'rescanned'
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # A delivery may have grown the file since it was stat()ed; the
+            # next update will look at the rest
+            st = os.fstat(f.fileno())
+        try:
+            if self._appended(mm):
+                result = 'appended'
+                start = self.offsets.pop()
+                self.count -= self.unread.pop()
+            else:
+                result = 'rescanned'
+                self.reset()
+                start = 0 if mm[:5] == 'From ' else self._next(mm, 0)
+            self._scan(mm, start)
+            self.size = len(mm)
+            self.mtime = st.st_mtime if st.st_size == len(mm) else None
+            self.head = zlib.crc32(mm[:self.HEAD])
+            self.anchor = self._anchor(mm)
+        finally:
+            mm.close()
+        return result
+
+    def _appended(self, mm):
+        # Whether the file is the indexed one with more appended to it
+        if not self.offsets or len(mm) <= self.size:
+            return False
+        return zlib.crc32(mm[:min(self.HEAD, self.size)]) == self.head and \
+            self._anchor(mm) == self.anchor
+
+    def _anchor(self, mm):
+        if not self.offsets:
+            return None
+        start = self.offsets[-1]
+        end = mm.find('\n', start)
+        return zlib.crc32(mm[start:end if end != -1 else len(mm)])
+
+    def _next(self, mm, pos):
+        # The start of the next message after pos, or -1
+        pos = mm.find('\nFrom ', pos)
+        return pos + 1 if pos != -1 else -1
+
+    def _scan(self, mm, pos):
+        # Index the messages from pos, the start of a message, onwards;
+        # only each message's headers are looked at
+        size = len(mm)
+        while pos != -1 and pos < size:
+            following = self._next(mm, pos)
+            end = mm.find('\n\n', pos,
+                          following if following != -1 else size)
+            if end == -1:
+                end = following if following != -1 else size
+            unread = 1
+            status = mm.find('\nStatus:', pos, end)
+            if status != -1:
+                eol = mm.find('\n', status + 1, end + 1)
+                if 'R' in mm[status + 8:eol if eol != -1 else end]:
+                    unread = 0
+            self.offsets.append(pos)
+            self.unread.append(unread)
+            self.count += unread
+            pos = following
+
+class AccountMbox(Account):
+    # Seconds without writes to the spool before reading what was delivered
+    DELAY = 0.5
+    MASK = inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | \
+        inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_ONLYDIR
+
+    def __init__(self, config, icon):
+        super(AccountMbox, self).__init__(config, icon)
+        path = config.get('path') or os.environ.get('MAIL') or \
+            os.path.join('/var/mail', os.environ.get('USER', ''))
+        self.path = os.path.expanduser(path)
+        self._index = MboxIndex()
+        self._cache = configmgr.cache_file('mbox', urllib.quote(self.path, ''))
+        try:
+            self._index.load(self._cache)
+        except (IOError, EOFError, ValueError, KeyError):
+            pass
+        self._inotify = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        with self.phase('search'):
+            result = self._index.update(self.path)
+        if result != 'unchanged':
+            self.recorder.record(result, '%d bytes' % (self._index.size,))
+            try:
+                self._index.save(self._cache)
+            except (IOError, OSError):
+                self.log.exception("Unable to save mbox index")
+        return self._index.count
+
+    def _open(self):
+        watch = inotify.Inotify()
+        try:
+            watch.add_watch(os.path.dirname(self.path), self.MASK)
+        except Exception:
+            watch.close()
+            raise
+        with self._lock:
+            self._inotify = watch
+        return watch
+
+    def _close(self, watch):
+        with self._lock:
+            if self._inotify is watch:
+                self._inotify = None
+        watch.close()
+
+    def abort_io(self):
+        with self._lock:
+            watch, self._inotify = self._inotify, None
+        if watch:
+            self.recorder.record('abort')
+            watch.abort()
+
+    def _changed(self, events):
+        # Whether any of the events (about the spool directory) are about
+        # the mbox
+        if not events:
+            raise IOError(errno.EIO, "Stopped watching %s" % (self.path,))
+        name = os.path.basename(self.path)
+        for path, mask, cookie, filename in events:
+            if mask & inotify.IN_IGNORED:
+                raise IOError(errno.ENOENT, "Stopped watching %s" % (path,))
+            if filename == name or mask & inotify.IN_Q_OVERFLOW:
+                return True
+        return False
+
+    def watch(self):
+        if not inotify.available():
+            return super(AccountMbox, self).watch()
+        return self._watch_inotify()
+
+    def _watch_inotify(self):
+        watch = self._open()
+        try:
+            count = None
+            while True:
+                if self._refresh() != count:
+                    count = self._index.count
+                    yield count
+                # Wait for the mbox to change, then for the writes to settle
+                changed = False
+                while True:
+                    wait = Wait(self.DELAY if changed else self.interval,
+                                watch)
+                    yield wait
+                    if not wait.ready:
+                        break
+                    changed = self._changed(watch.read()) or changed
+                if not changed:
+                    count = None    # Report it again, as a sign of life
+        finally:
+            self._close(watch)
+
+    def cache_files(self):
+        return [self._cache]
+
+    def check(self):
+        return self._refresh()
+
+Account = AccountMbox
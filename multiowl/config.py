@@ -1,8 +1,14 @@
 import logging
 
 import os
+import select
+import threading
+import Queue
+import time
 from ConfigParser import RawConfigParser
 
+from . import inotify
+
 CHECK_INTERVAL = 300
 
 KEYRING_SERVICE = 'multiowl'
@@ -11,17 +17,90 @@ _CONFIG_DIR = os.environ.get('XDG_CONFIG_HOME',
                              os.path.join(os.path.expanduser('~'), '.config'))
 CONFIG_FILE = os.path.join(_CONFIG_DIR, 'multiowl', 'config')
 
+_CACHE_DIR = os.environ.get('XDG_CACHE_HOME',
+                            os.path.join(os.path.expanduser('~'), '.cache'))
+CACHE_DIR = os.path.join(_CACHE_DIR, 'multiowl')
+
+def cache_file(*names):
+    """Return the path of a file in the cache directory, creating any
+    missing directories."""
+    path = os.path.join(CACHE_DIR, *names)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    return path
+
 class PasswordManager(object):
+    """Passwords from the keyring, by username.
+
+    Looking a password up can be a D-Bus round trip or even wait for the
+    user to unlock the keyring, so prefetch() looks passwords up on a few
+    background threads, and reading one waits only for that lookup."""
+
+    WORKERS = 4
+
     def __init__(self):
         self.passwords = {}
         self.keyring = __import__('keyring') # Must be imported after dbus, GTK
         self.log = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self._loaded = {}       # Username -> Event set once looked up
+        self._queue = Queue.Queue()
+        self._workers = 0
+        self._pending = 0
+        self._started = None    # When the current batch of lookups began
+        self._lookup_time = 0
 
     def __getitem__(self, username):
+        with self.lock:
+            loaded = self._loaded.get(username)
+        if loaded:
+            loaded.wait()
         if username in self.passwords:
             return self.passwords[username]
         return None
 
+    def prefetch(self, username):
+        # Start looking up a password, unless it is already known or queued
+        with self.lock:
+            if username in self._loaded:
+                return
+            self._loaded[username] = threading.Event()
+            if not self._pending:
+                self._started = time.time()
+                self._lookup_time = 0
+            self._pending += 1
+            if self._workers < self.WORKERS:
+                self._workers += 1
+                worker = threading.Thread(target=self._work,
+                                          name='PasswordManager-%d' %
+                                          (self._workers,))
+                worker.daemon = True
+                worker.start()
+        self._queue.put(username)
+
+    def _work(self):
+        while True:
+            username = self._queue.get()
+            start = time.time()
+            try:
+                self.load(username)
+            except Exception:
+                self.log.exception("Unable to load password for %s" %
+                                   (username,))
+                self.passwords[username] = None
+            with self.lock:
+                self._lookup_time += time.time() - start
+                self._pending -= 1
+                if not self._pending:
+                    self.log.info("Loaded passwords in %.3f sec "
+                                  "(%.3f sec of lookups)" %
+                                  (time.time() - self._started,
+                                   self._lookup_time))
+                loaded = self._loaded[username]
+            loaded.set()
+
     def load(self, username):
         #self.log.debug("Loading password for %s" % (username,))
         password = self.keyring.get_password(KEYRING_SERVICE, username)
@@ -58,3 +137,71 @@ class Config(RawConfigParser):
             else:
                 config['interval'] = int(config['interval'])
             yield config
+
+class ConfigWatcher(object):
+    """Calls changed() whenever CONFIG_FILE has been written, on a thread of
+    its own.
+
+    The directory is watched rather than the file, since editors usually
+    replace the file, and a burst of changes (e.g. one write per section)
+    results in a single call once the file has been quiet for DELAY seconds.
+    Without inotify, the file is polled every POLL seconds instead."""
+
+    DELAY = 0.5
+    POLL = 5
+    MASK = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | \
+        inotify.IN_MOVED_FROM | inotify.IN_DELETE
+
+    def __init__(self, changed, path=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.changed = changed
+        self.path = path or CONFIG_FILE
+        self.thread = threading.Thread(target=self._run, name='ConfigWatcher')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        directory, name = os.path.split(self.path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+        try:
+            watch = inotify.Inotify()
+            watch.add_watch(directory, self.MASK | inotify.IN_ONLYDIR)
+        except OSError as e:
+            self.log.warning("Unable to watch %s (%s); polling instead" %
+                             (directory, e))
+            return self._poll()
+        while True:
+            if not any(event[3] == name for event in watch.read()):
+                continue
+            # Wait for the writes to settle
+            while select.select([watch], [], [], self.DELAY)[0]:
+                watch.read()
+            self._changed()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
+    def _poll(self):
+        last = self._stat()
+        while True:
+            time.sleep(self.POLL)
+            current = self._stat()
+            if current != last:
+                last = current
+                self._changed()
+
+    def _changed(self):
+        self.log.info("%s changed" % (self.path,))
+        try:
+            self.changed()
+        except Exception:
+            self.log.exception("Error while handling configuration change")
@@ -0,0 +1,66 @@
+import logging
+import os
+
+import dbus
+
+class ConnectivityMonitor(object):
+    """Tracks whether the network is usable, and tells listeners when that
+    changes. This base class is also a stand-in that is only changed by
+    calling set_online, e.g. for testing or when NetworkManager is
+    unavailable. Listeners are called from the thread calling set_online,
+    which for MultiowlApp must be the main one."""
+
+    def __init__(self, online=True):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.online = online
+        self._listeners = []
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def set_online(self, online):
+        if online == self.online:
+            return
+        self.online = online
+        self.log.info("Now %s" % ('online' if online else 'offline',))
+        for callback in self._listeners:
+            callback(online)
+
+class NetworkManagerMonitor(ConnectivityMonitor):
+    """Follows NetworkManager's state over the D-Bus system bus."""
+
+    NM_NAME = 'org.freedesktop.NetworkManager'
+    NM_PATH = '/org/freedesktop/NetworkManager'
+    NM_STATE_UNKNOWN = 0
+    NM_STATE_CONNECTED_SITE = 60
+
+    def __init__(self, bus=None):
+        bus = bus or dbus.SystemBus()
+        manager = bus.get_object(self.NM_NAME, self.NM_PATH)
+        state = manager.Get(self.NM_NAME, 'State',
+                            dbus_interface=dbus.PROPERTIES_IFACE)
+        super(NetworkManagerMonitor, self).__init__(self._is_online(state))
+        bus.add_signal_receiver(self._state_changed, 'StateChanged',
+                                self.NM_NAME, self.NM_NAME, self.NM_PATH)
+
+    def _is_online(self, state):
+        # Mail servers may be on the local site; if NetworkManager does not
+        # know, assume the network works
+        return state == self.NM_STATE_UNKNOWN or \
+            state >= self.NM_STATE_CONNECTED_SITE
+
+    def _state_changed(self, state):
+        self.set_online(self._is_online(state))
+
+def create_monitor():
+    # MULTIOWL_CONNECTIVITY=online or offline starts a stand-in monitor in
+    # that state instead of following NetworkManager
+    forced = os.environ.get('MULTIOWL_CONNECTIVITY', '').lower()
+    if forced in ('online', 'offline'):
+        return ConnectivityMonitor(forced == 'online')
+    try:
+        return NetworkManagerMonitor()
+    except dbus.DBusException:
+        logging.getLogger(__name__).warning(
+            "NetworkManager is not available; assuming always online")
+        return ConnectivityMonitor()
@@ -0,0 +1,230 @@
+import logging
+
+import threading
+import Queue
+import heapq
+import os, select
+import errno
+import time
+
+from .account import Wait, close_watcher
+
+class CheckerTask(object):
+    """The state of one account's watcher on the CheckerLoop; stands in for
+    the account's CheckerThread."""
+    def __init__(self, account):
+        self.account = account
+        self.abort = False
+        self.watcher = None
+        self.wait = None
+        self.error = None       # Why its wait failed, to fail the check
+
+class CheckerLoop(object):
+    """Drive the watchers of all accounts from a single thread.
+
+    Waiting (sleeping between checks and IMAP IDLE) is multiplexed with
+    select() on the loop thread.  The blocking parts of each watcher
+    (connecting, logging in and checking) are stepped on a small pool of
+    worker threads, so the number of threads no longer grows with the number
+    of accounts."""
+
+    WORKERS = 4
+
+    def __init__(self, workers=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self._timers = []       # Heap of (deadline, seq, task)
+        self._readers = {}      # Socket -> task
+        self._seq = 0
+        self._paused = []       # Tasks waiting for connectivity
+        self._queue = Queue.Queue()
+        self._wakeup = os.pipe()
+
+        self._thread = threading.Thread(target=self._run, name='CheckerLoop')
+        self._thread.daemon = True
+        self._thread.start()
+        for i in range(workers or self.WORKERS):
+            worker = threading.Thread(target=self._work,
+                                      name='CheckerWorker-%d' % (i,))
+            worker.daemon = True
+            worker.start()
+
+    def spawn(self, account):
+        task = CheckerTask(account)
+        scheduler = account.app.scheduler
+        self._park(task, time.time() + scheduler.first_delay(account))
+        return task
+
+    def cancel(self, task):
+        # Hand an aborted task that is sleeping or paused to a worker at once,
+        # to close its watcher; one waiting on its socket is woken by
+        # abort_io(), and one that is running notices by itself
+        with self.lock:
+            if task.wait and task.wait.sock in self._readers:
+                return
+            parked = task in self._paused or \
+                any(entry[2] is task for entry in self._timers)
+            if task in self._paused:
+                self._paused.remove(task)
+            self._timers = [x for x in self._timers if x[2] is not task]
+            heapq.heapify(self._timers)
+        if parked:
+            self._queue.put(task)
+
+    def resume(self):
+        # Connectivity is back
+        with self.lock:
+            paused, self._paused = self._paused, []
+        for task in paused:
+            self._queue.put(task)
+
+    def stats(self):
+        # How many tasks are in each state
+        with self.lock:
+            return {'sleeping': len(self._timers) - len(self._readers),
+                    'waiting': len(self._readers),
+                    'paused': len(self._paused),
+                    'runnable': self._queue.qsize()}
+
+    def _wake(self):
+        os.write(self._wakeup[1], 'x')
+
+    def _park(self, task, when, sock=None):
+        # Hand a task back to the loop thread until it has something to do
+        with self.lock:
+            self._seq += 1
+            heapq.heappush(self._timers, (when, self._seq, task))
+            if sock is not None:
+                self._readers[sock] = task
+        self._wake()
+
+    def _run(self):
+        # Every account on the loop depends on this thread, so it carries
+        # on whatever happens
+        while True:
+            try:
+                self._poll()
+            except Exception:
+                self.log.exception("Error in the event loop")
+                time.sleep(1)
+
+    def _poll(self):
+        with self.lock:
+            timeout = self._timers[0][0] - time.time() \
+                if self._timers else None
+            readers = self._readers.keys()
+        if timeout is not None:
+            timeout = max(timeout, 0)
+        try:
+            ready = select.select([self._wakeup[0]] + readers, (), (),
+                                  timeout)[0]
+        except Exception as e:
+            if isinstance(e, select.error) and e.args[0] == errno.EINTR:
+                return
+            # E.g. a socket closed while still waited on
+            if not self._fail_readers():
+                raise
+            return
+        if self._wakeup[0] in ready:
+            os.read(self._wakeup[0], 4096)
+
+        # Collect tasks whose socket is readable or whose time has come
+        now = time.time()
+        runnable = []
+        with self.lock:
+            for sock in ready:
+                if sock in self._readers:
+                    task = self._readers.pop(sock)
+                    task.wait.ready = True
+                    runnable.append(task)
+            while self._timers and self._timers[0][0] <= now:
+                task = heapq.heappop(self._timers)[2]
+                if task.wait and task.wait.sock is not None:
+                    self._readers.pop(task.wait.sock, None)
+                runnable.append(task)
+            if runnable:
+                # Drop the other references to the tasks being resumed
+                self._timers = [x for x in self._timers
+                                if x[2] not in runnable]
+                heapq.heapify(self._timers)
+        for task in runnable:
+            self._queue.put(task)
+
+    def _fail_readers(self):
+        # Find the sockets select() cannot wait on, and hand their tasks to
+        # a worker to fail the check; returns whether there were any
+        failed = []
+        with self.lock:
+            for sock, task in self._readers.items():
+                try:
+                    select.select([sock], (), (), 0)
+                except Exception as e:
+                    del self._readers[sock]
+                    task.error = e
+                    failed.append(task)
+            if failed:
+                self._timers = [x for x in self._timers
+                                if x[2] not in failed]
+                heapq.heapify(self._timers)
+        for task in failed:
+            self._queue.put(task)
+        return bool(failed)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                self._step(task)
+            except Exception:
+                task.account.log.exception("Error in the event loop")
+
+    def _step(self, task):
+        account = task.account
+        scheduler = account.app.scheduler
+        task.wait = None
+        if task.abort:
+            if task.watcher:
+                close_watcher(account, task.watcher)
+                task.watcher = None
+            account.log.warning("Task exiting")
+            return
+        try:
+            if task.error:
+                # Its wait failed: end the check with the error, as the
+                # watcher itself would have
+                error, task.error = task.error, None
+                if task.watcher:
+                    close_watcher(account, task.watcher)
+                    task.watcher = None
+                raise error
+            if not task.watcher:
+                if not scheduler.online:
+                    with self.lock:
+                        self._paused.append(task)
+                    return
+                task.watcher = account.watch()
+            # Run the watcher until it has to wait
+            for count in task.watcher:
+                if task.abort:
+                    break
+                if isinstance(count, Wait):
+                    task.wait = count
+                    self._park(task, time.time() + count.timeout,
+                               count.sock)
+                    return
+                scheduler.checked(account, count)
+                account.count = count
+        except Exception as e:
+            if not task.abort:
+                account.log.exception("Got an exception")
+                account.failed(e)
+        # The watcher has finished; start over later
+        if task.abort and task.watcher:
+            close_watcher(account, task.watcher)
+        task.watcher = None
+        if task.abort:
+            account.log.warning("Task exiting")
+            return
+        delay = scheduler.failed(account)
+        account.log.info("Waiting %d sec before retrying" % (delay,))
+        self._park(task, time.time() + delay)
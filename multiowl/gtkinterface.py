@@ -1,15 +1,20 @@
 import gtk, gobject, cairo
-from StringIO import StringIO
 import dbus.mainloop.glib
 
 from .__init__ import MailIconBase, AccountIconDataBase
 import logging
 
 import threading
+import sys, time
+import array, operator
+from collections import OrderedDict
 
 gtk.threads_init()
 
 def make_pixbuf(base, color, label):
+    return surface_to_pixbuf(draw_badge(base, color, label))
+
+def draw_badge(base, color, label):
     # Convert the base image to a Cairo surface
     size = base.get_width()
     surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
@@ -65,14 +70,101 @@ def make_pixbuf(base, color, label):
     #cr.move_to((size-text_width-1)/2.0, (size+text_height)/2.0)
     cr.show_text(my_str)
 
-    # Render back to a GdkPixbuf via a PNG (!)
-    png = StringIO()
-    surface.write_to_png(png)
-    loader = gtk.gdk.PixbufLoader()
-    loader.write(png.getvalue())
-    # Is this sufficient to ensure the image is completely loaded?
-    loader.close()
-    return loader.get_pixbuf()
+    surface.flush()
+    return surface
+
+_UNPREMULTIPLY = None
+
+def _unpremultiply_table():
+    # The straight value of each premultiplied value v at alpha a, at index
+    # a * 256 + v, so that a pixel's channel and alpha read as one native
+    # 16-bit word (on little-endian machines) index it
+    global _UNPREMULTIPLY
+    if _UNPREMULTIPLY is None:
+        table = bytearray(256)      # Alpha 0
+        for alpha in xrange(1, 256):
+            table += bytearray(min(255, v * 255 // alpha) for v in xrange(256))
+        _UNPREMULTIPLY = str(table)
+    return _UNPREMULTIPLY
+
+def surface_to_pixbuf(surface):
+    # Convert an ARGB32 Cairo surface to a GdkPixbuf. Cairo stores each
+    # pixel as a native-endian word with premultiplied alpha, whereas
+    # GdkPixbuf wants RGBA bytes without. Everything is done with slices
+    # and a table lookup in C rather than a loop over the pixels.
+    data = str(surface.get_data())
+    if sys.byteorder == 'little':
+        b, g, r, a = 0, 1, 2, 3
+        value, weight = 0, 1        # Byte offsets within each 16-bit index
+    else:
+        a, r, g, b = 0, 1, 2, 3
+        value, weight = 1, 0
+    alpha = data[a::4]
+    pixels = bytearray(len(data))
+    pixels[3::4] = alpha
+    if not alpha.translate(None, '\x00\xff'):
+        # Fully opaque or transparent pixels only: nothing to undo
+        pixels[0::4] = data[r::4]
+        pixels[1::4] = data[g::4]
+        pixels[2::4] = data[b::4]
+    else:
+        n = len(alpha)
+        index = bytearray(6 * n)
+        index[weight::2] = alpha * 3
+        index[value:2*n:2] = data[r::4]
+        index[2*n+value:4*n:2] = data[g::4]
+        index[4*n+value::2] = data[b::4]
+        straight = ''.join(operator.itemgetter(
+            *array.array('H', str(index)))(_unpremultiply_table()))
+        pixels[0::4] = straight[:n]
+        pixels[1::4] = straight[n:2*n]
+        pixels[2::4] = straight[2*n:]
+    return gtk.gdk.pixbuf_new_from_data(str(pixels), gtk.gdk.COLORSPACE_RGB,
+                                        True, 8, surface.get_width(),
+                                        surface.get_height(),
+                                        surface.get_stride())
+
+class BadgeCache(object):
+    """Least-recently-used cache of rendered account badges, keyed by icon
+    size, color and label."""
+    SIZE = 256
+
+    def __init__(self, size=None):
+        self.size = size or self.SIZE
+        self.badges = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.render_time = 0.0
+
+    def get(self, base, color, label):
+        key = (base.get_width(), color, unicode(label))
+        pixbuf = self.badges.pop(key, None)
+        if pixbuf is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            start = time.time()
+            pixbuf = make_pixbuf(base, color, label)
+            self.render_time += time.time() - start
+            if len(self.badges) >= self.size:
+                self.badges.popitem(last=False)
+        self.badges[key] = pixbuf
+        return pixbuf
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else None,
+                'render_time': self.render_time,
+                'render_time_avg': self.render_time / self.misses
+                if self.misses else None,
+                'entries': len(self.badges)}
+
+BADGES = BadgeCache()
+
+def render_stats():
+    # For the GetMetrics D-Bus method
+    return {'badges': BADGES.stats()}
 
 def update_timer(timer, interval, callback):
     if timer is not None:
@@ -80,6 +172,13 @@ def update_timer(timer, interval, callback):
     return gobject.timeout_add(interval, callback) \
         if interval is not None else None
 
+def call_later(interval, callback):
+    # Call callback once on the main loop, interval ms from now
+    def call():
+        callback()
+        return False
+    gobject.timeout_add(interval, call)
+
 MAIN_THREAD = threading.current_thread()
 
 class AccountIconDataGtk(AccountIconDataBase):
@@ -113,8 +212,8 @@ class MailIconGtk(MailIconBase):
     #                                                 self.icon.get_visible()))
     #     return True
 
-    def _update(self, *args, **kwargs):
-        self.update(*args, **kwargs)
+    def _update(self):
+        self.update()
         return False            # Do not call again
 
     def _resize_icon(self, icon, size):
@@ -128,7 +227,7 @@ class MailIconGtk(MailIconBase):
         icon.set_from_pixbuf(self.base)
         # Wait for icon to realize, else bad things happen (the Cairo text
         # API will have trouble with text)
-        gobject.idle_add(self._update)
+        self.notify()
         return True
 
     def refresh_tooltip(self, heading, accounts):
@@ -151,9 +250,9 @@ class MailIconGtk(MailIconBase):
     def refresh_account_icon(self, account):
         if not self.base:
             return
-        account.icondata.pixbuf = make_pixbuf(self.base,
-                                              account.icondata.color,
-                                              account.count)
+        account.icondata.pixbuf = BADGES.get(self.base,
+                                             account.icondata.color,
+                                             account.count)
 
     def _check_obsolete(self):
         self.check_obsolete()
@@ -171,8 +270,8 @@ class MailIconGtk(MailIconBase):
         self.timer_cycle = update_timer(self.timer_cycle, interval,
                                         self._cycle)
 
-    def notify(self, account=None):
-        gobject.idle_add(self._update, account)
+    def schedule_update(self):
+        gobject.timeout_add(self.FRAME, self._update)
 
 MailIcon = MailIconGtk
 
@@ -0,0 +1,111 @@
+import os
+import errno
+import struct
+import threading
+import ctypes, ctypes.util
+
+# A minimal binding of Linux's inotify, for watching the configuration and
+# mail files without polling.
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+_libc = None
+
+def _load():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        _libc = libc
+    return _libc
+
+def available():
+    try:
+        _load()
+        return True
+    except OSError:
+        return False
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+class Inotify(object):
+    """An inotify instance; read() blocks until there are events, so use
+    select() on fileno() to wait for them with a timeout."""
+
+    def __init__(self):
+        self.fd = _check(_load().inotify_init1(IN_CLOEXEC))
+        self.paths = {}         # Watch descriptor -> path
+        # Held by abort() and close(), so that the descriptor is not closed,
+        # and its number reused, while abort() is still removing watches
+        self._lock = threading.Lock()
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = _check(_libc.inotify_add_watch(self.fd, path, mask))
+        self.paths[wd] = path
+        return wd
+
+    def remove_watch(self, wd):
+        self.paths.pop(wd, None)
+        try:
+            _check(_libc.inotify_rm_watch(self.fd, wd))
+        except OSError as e:
+            if e.errno != errno.EINVAL:     # Already gone with its file
+                raise
+
+    def read(self):
+        # Returns a list of (path, mask, cookie, name)
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            events.append((self.paths.get(wd), mask, cookie, name))
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+        return events
+
+    def abort(self):
+        # Like shutting a socket down: removing a watch queues an IN_IGNORED
+        # event, waking anything waiting on the descriptor, while leaving it
+        # open (it may be in use by select). Whoever is woken waits for this
+        # to finish before closing it.
+        with self._lock:
+            if self.fd is None:
+                return
+            for wd in list(self.paths):
+                if _libc.inotify_rm_watch(self.fd, wd) < 0:
+                    break
+
+    def close(self):
+        with self._lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
@@ -0,0 +1,132 @@
+import threading
+import bisect
+import os
+import resource
+
+from . import sslutils
+
+# Per-account latency, traffic and error counters, cheap enough to keep on:
+# recording is a few additions under a per-account lock, and everything else
+# happens only when a snapshot is taken.
+
+class Histogram(object):
+    """Counts of durations, in fixed buckets of seconds."""
+
+    BOUNDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def snapshot(self):
+        # The last bucket has no upper bound
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'buckets': zip(self.BOUNDS + (None,), self.buckets)}
+
+class AccountMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}    # Phase -> Histogram
+        self.errors = {}        # Exception class name -> count
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Traffic on compressed connections, as sent over the wire and as
+        # it was before compression
+        self.compression = {'wire_in': 0, 'wire_out': 0,
+                            'plain_in': 0, 'plain_out': 0}
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            if phase not in self.histograms:
+                self.histograms[phase] = Histogram()
+            self.histograms[phase].observe(seconds)
+
+    def error(self, exc):
+        name = exc.__class__.__name__
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def transferred(self, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def compressed(self, wire_in=0, wire_out=0, plain_in=0, plain_out=0):
+        with self.lock:
+            self.compression['wire_in'] += wire_in
+            self.compression['wire_out'] += wire_out
+            self.compression['plain_in'] += plain_in
+            self.compression['plain_out'] += plain_out
+
+    def snapshot(self):
+        with self.lock:
+            return {'phases': dict((phase, histogram.snapshot())
+                                   for phase, histogram
+                                   in self.histograms.items()),
+                    'errors': dict(self.errors),
+                    'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                    'compression': dict(self.compression)}
+
+class CountingFile(object):
+    """Wraps a file from socket.makefile, counting the bytes read."""
+    def __init__(self, fp, metrics):
+        self.fp = fp
+        self.metrics = metrics
+
+    def read(self, *args):
+        data = self.fp.read(*args)
+        self.metrics.transferred(bytes_in=len(data))
+        return data
+
+    def readline(self, *args):
+        data = self.fp.readline(*args)
+        self.metrics.transferred(bytes_in=len(data))
+        return data
+
+    def close(self):
+        self.fp.close()
+
+class CountingSocket(object):
+    """Wraps a socket so that what httplib.HTTPResponse reads from it is
+    counted."""
+    def __init__(self, sock, metrics):
+        self.sock = sock
+        self.metrics = metrics
+
+    def makefile(self, *args):
+        return CountingFile(self.sock.makefile(*args), self.metrics)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.metrics.transferred(bytes_out=len(data))
+
+def rss():
+    # Resident set size in bytes; where /proc is missing, the peak instead
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def snapshot(app):
+    # Everything at once, for the GetMetrics D-Bus method
+    process = {'rss': rss(), 'threads': threading.active_count(),
+               'pid': os.getpid()}
+    if app.loop:
+        process['tasks'] = app.loop.stats()
+    result = {'process': process, 'ssl': sslutils.get_stats(),
+              'accounts': dict((name, app.accounts[name].metrics.snapshot())
+                               for name in app.accountnames)}
+    # Rendering, where the user interface keeps statistics on it
+    render_stats = getattr(app.ui, 'render_stats', None)
+    if render_stats:
+        result['render'] = render_stats()
+    return result
@@ -0,0 +1,93 @@
+import logging
+
+import threading
+import Queue
+import time
+from collections import OrderedDict
+
+from . import config as configmgr
+from .account import account_module
+from .scheduler import Scheduler
+
+# Check every account once, without GTK, and report the counts as JSON.
+# Nothing here may import gtk, gobject or cairo, so that this starts quickly
+# enough to be run from status bars and cron.
+
+class OneShotIcon(object):
+    """Stands in for the MailIcon that accounts report their counts to."""
+    def __init__(self, app):
+        self.app = app
+
+    def notify(self, account=None):
+        pass
+
+class OneShotApp(object):
+    """Stands in for MultiowlApp, checking each account once."""
+
+    WORKERS = 8
+
+    def __init__(self, config=None, workers=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.config = config or configmgr.Config()
+        self.workers = workers or self.WORKERS
+        self.loop = None
+        self.scheduler = Scheduler()
+        self.passwords = configmgr.PasswordManager()
+        self.icon = OneShotIcon(self)
+
+    def count_changed(self, account):
+        pass
+
+    def check_account(self, config):
+        # Returns this account's entry in the report
+        result = OrderedDict([('type', config.get('type')),
+                              ('count', None)])
+        start = time.time()
+        try:
+            module = account_module(config['type'])
+            account = module.Account(config, self.icon)
+            count = account.check()
+            if isinstance(count, dict):
+                result['counts'] = count
+                account.count = count
+                count = account.count
+            result['count'] = count
+        except Exception as e:
+            self.log.debug("%s failed" % (config['name'],), exc_info=True)
+            result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        result['seconds'] = round(time.time() - start, 3)
+        return result
+
+    def check_all(self):
+        # Check the accounts in parallel, on a bounded pool of threads
+        configs = list(self.config.accounts())
+        results = OrderedDict((config['name'], None) for config in configs)
+        queue = Queue.Queue()
+        for config in configs:
+            queue.put(config)
+
+        def work():
+            while True:
+                try:
+                    config = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                results[config['name']] = self.check_account(config)
+
+        threads = [threading.Thread(target=work, name='OneShot-%d' % (i,))
+                   for i in range(min(self.workers, len(configs)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def report(self):
+        results = self.check_all()
+        counts = [result['count'] for result in results.values()
+                  if type(result['count']) is int]
+        return OrderedDict([('total', sum(counts)),
+                            ('errors', len([x for x in results.values()
+                                            if 'error' in x])),
+                            ('accounts', results)])
@@ -0,0 +1,75 @@
+import threading
+import collections
+import ctypes, ctypes.util
+import time
+
+# A flight recorder of each account's recent protocol events, to look at
+# after something went wrong without running with debug logging. Recording
+# is an append to a bounded deque, and only happens when there is traffic.
+
+CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _monotonic_clock():
+    # time.monotonic() is not in Python 2; fall back to the wall clock
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    def monotonic():
+        ts = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            return time.time()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _monotonic_clock()
+
+class FlightRecorder(object):
+    """The last SIZE events of one account, as (monotonic time, event,
+    detail), with details cut to DETAIL characters."""
+
+    SIZE = 256
+    DETAIL = 200
+
+    def __init__(self, size=None):
+        self.lock = threading.Lock()
+        self.events = collections.deque(maxlen=size or self.SIZE)
+
+    def record(self, event, detail=''):
+        if len(detail) > self.DETAIL:
+            detail = detail[:self.DETAIL] + '...'
+        with self.lock:
+            self.events.append((monotonic(), event, detail))
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.events)
+
+def snapshot(app):
+    # Every account's events, for the GetFlightRecord D-Bus method; 'ago' is
+    # how many seconds before the snapshot each happened
+    now = monotonic()
+    return {'monotonic': now, 'time': time.time(),
+            'accounts': dict((name, [{'monotonic': t, 'ago': now - t,
+                                      'event': event, 'detail': detail}
+                                     for t, event, detail
+                                     in app.accounts[name].recorder.snapshot()])
+                             for name in app.accountnames)}
+
+def dump(app, f):
+    # Every account's events in the order they happened, one per line, with
+    # the wall clock time they happened at
+    now, wall = monotonic(), time.time()
+    events = sorted((t, name, event, detail)
+                    for name in app.accountnames
+                    for t, event, detail
+                    in app.accounts[name].recorder.snapshot())
+    for t, name, event, detail in events:
+        when = wall - (now - t)
+        f.write('%s.%03d %s %s %s\n' %
+                (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)),
+                 int(when * 1000) % 1000, name, event, detail))
@@ -0,0 +1,223 @@
+import logging
+
+import threading
+import random
+import heapq
+import time
+from contextlib import contextmanager
+
+class AccountSchedule(object):
+    """When an account was and will next be checked, and why."""
+    def __init__(self, account):
+        self.interval = account.interval
+        self.failures = 0
+        self.delay = None
+        self.next_check = None
+        self.last_check = None
+        self.last_count = None
+        self.last_mail = None
+        self.mail_interval = None   # Smoothed time between new messages
+
+    def snapshot(self, now):
+        return {'interval': self.interval, 'failures': self.failures,
+                'delay': self.delay, 'mail_interval': self.mail_interval,
+                'next_check': self.next_check - now
+                if self.next_check else None,
+                'last_check': now - self.last_check
+                if self.last_check else None}
+
+class Scheduler(object):
+    """Decides when each account is checked.
+
+    First checks are staggered, errors back off exponentially, polling
+    adapts to how often an account gets mail, every delay gets some jitter,
+    and only a few connections to the same host are set up at once. It also
+    enforces deadlines on the phases of each check."""
+
+    JITTER = 0.1            # Delays vary by up to 10% either way
+    STAGGER = 0.25          # Seconds between consecutive first checks
+    RETRY = 15              # First retry after an error, doubling after
+    MAX_BACKOFF = 30*60
+    MIN_FACTOR = 0.5        # Polling adapts between half and four times
+    MAX_FACTOR = 4          # the configured interval
+    SMOOTHING = 0.25
+    HOST_LIMIT = 4          # Connections being set up per host
+    SETUP_LIMIT = 16        # Connections being set up in total
+    WATCHDOG_INTERVAL = 1
+
+    def __init__(self):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.schedules = {}
+        self._next_slot = 0
+        self._hosts = {}
+        self._connecting = {}
+        self._setup = threading.BoundedSemaphore(self.SETUP_LIMIT)
+        self._online = threading.Event()
+        self._online.set()
+        self._deadlines = []    # Heap of [deadline, callback, what, active]
+        self._watchdog = None
+
+    @property
+    def online(self):
+        return self._online.is_set()
+
+    def pause(self):
+        # Hold back new connections until resume()
+        self._online.clear()
+
+    def resume(self):
+        # Connectivity is back: forget earlier failures and start afresh
+        with self.lock:
+            for schedule in self.schedules.values():
+                schedule.failures = 0
+            self._next_slot = 0
+        self._online.set()
+
+    def wait_online(self):
+        # Block until not paused
+        while not self._online.wait(60):
+            pass
+
+    def _schedule(self, account):
+        # Call with the lock held
+        if account.name not in self.schedules:
+            self.schedules[account.name] = AccountSchedule(account)
+        return self.schedules[account.name]
+
+    def _set(self, account, schedule, delay, why):
+        delay *= random.uniform(1 - self.JITTER, 1 + self.JITTER)
+        schedule.delay = delay
+        schedule.next_check = time.time() + delay
+        account.log.debug("Next check in %d sec (%s)" % (delay, why))
+        return delay
+
+    def first_delay(self, account):
+        # Give each account that starts its own slot, so that starting many
+        # accounts at once does not mean connecting them all at once
+        now = time.time()
+        with self.lock:
+            schedule = self._schedule(account)
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.STAGGER
+            schedule.interval = account.interval
+            return self._set(account, schedule, slot - now, "first check")
+
+    def poll_delay(self, account):
+        # Poll accounts that get mail often more often, and vice versa
+        now = time.time()
+        with self.lock:
+            schedule = self._schedule(account)
+            delay = account.interval
+            if schedule.mail_interval:
+                quiet = now - schedule.last_mail
+                factor = max(schedule.mail_interval, quiet) / account.interval
+                delay *= min(max(factor, self.MIN_FACTOR), self.MAX_FACTOR)
+            return self._set(account, schedule, delay, "poll")
+
+    def failed(self, account):
+        with self.lock:
+            schedule = self._schedule(account)
+            schedule.failures += 1
+            delay = min(self.RETRY * 2 ** (schedule.failures - 1),
+                        self.MAX_BACKOFF)
+            return self._set(account, schedule, delay,
+                             "%d failures" % (schedule.failures,))
+
+    def checked(self, account, count):
+        now = time.time()
+        with self.lock:
+            schedule = self._schedule(account)
+            schedule.failures = 0
+            schedule.next_check = None
+            schedule.last_check = now
+            if isinstance(count, dict):
+                count = sum(x for x in count.values() if type(x) is int)
+            if type(count) is int and type(schedule.last_count) is int and \
+               count > schedule.last_count:
+                # New mail
+                if schedule.last_mail:
+                    elapsed = now - schedule.last_mail
+                    schedule.mail_interval = elapsed \
+                        if schedule.mail_interval is None else \
+                        schedule.mail_interval * (1 - self.SMOOTHING) + \
+                        elapsed * self.SMOOTHING
+                schedule.last_mail = now
+            if type(count) is int:
+                schedule.last_count = count
+
+    def forget(self, account):
+        # The account has been removed
+        with self.lock:
+            self.schedules.pop(account.name, None)
+
+    def due(self, account):
+        # When a waiting account is next expected to check in, or None
+        with self.lock:
+            schedule = self.schedules.get(account.name)
+            return schedule and schedule.next_check
+
+    @contextmanager
+    def connecting(self, host):
+        # Limit the connections being set up to each host, and in total so
+        # that reconnecting everything at once is queued
+        with self.lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.HOST_LIMIT)
+                self._connecting[host] = 0
+            semaphore = self._hosts[host]
+        semaphore.acquire()
+        self._setup.acquire()
+        with self.lock:
+            self._connecting[host] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self._connecting[host] -= 1
+            self._setup.release()
+            semaphore.release()
+
+    @contextmanager
+    def deadline(self, seconds, callback, what):
+        # Call callback, e.g. to close a connection, if the block is still
+        # running after the given number of seconds
+        entry = [time.time() + seconds, callback, what, True]
+        with self.lock:
+            heapq.heappush(self._deadlines, entry)
+            if not self._watchdog:
+                self._watchdog = threading.Thread(target=self._watch,
+                                                  name='Watchdog')
+                self._watchdog.daemon = True
+                self._watchdog.start()
+        try:
+            yield
+        finally:
+            entry[3] = False
+
+    def _watch(self):
+        while True:
+            time.sleep(self.WATCHDOG_INTERVAL)
+            now = time.time()
+            expired = []
+            with self.lock:
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    entry = heapq.heappop(self._deadlines)
+                    if entry[3]:
+                        expired.append(entry)
+            for entry in expired:
+                self.log.warning("Deadline exceeded: %s" % (entry[2],))
+                try:
+                    entry[1]()
+                except Exception:
+                    self.log.exception("Unable to abort %s" % (entry[2],))
+
+    def snapshot(self):
+        # The effective schedule, for debugging
+        now = time.time()
+        with self.lock:
+            return {'accounts': dict((name, schedule.snapshot(now))
+                                     for name, schedule
+                                     in self.schedules.items()),
+                    'connecting': dict(self._connecting),
+                    'online': self.online}
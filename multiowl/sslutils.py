@@ -1,5 +1,44 @@
 import ssl
 import socket, httplib, urllib2
+import threading
+import time
+
+# SSL contexts, by (purpose, keyfile, certfile); loading the system CA
+# certificates for each connection is expensive. TLS sessions are not
+# resumed: that needs ssl.SSLSession (Python 3.6+), and multiowl runs on
+# Python 2.
+_contexts = {}
+# Extra CA certificates to trust, e.g. a local test server's
+_cafiles = []
+_lock = threading.Lock()
+
+stats = {'context_hits': 0, 'context_misses': 0}
+
+def get_context(purpose=ssl.Purpose.SERVER_AUTH, keyfile=None, certfile=None):
+    key = (purpose, keyfile, certfile)
+    with _lock:
+        if key in _contexts:
+            stats['context_hits'] += 1
+            return _contexts[key]
+        stats['context_misses'] += 1
+        sslctx = ssl.create_default_context(purpose)
+        for cafile in _cafiles:
+            sslctx.load_verify_locations(cafile)
+        if keyfile or certfile:
+            sslctx.load_cert_chain(certfile, keyfile)
+        sslctx.verify_mode = ssl.CERT_REQUIRED # Should be default
+        _contexts[key] = sslctx
+    return sslctx
+
+def trust(cafile):
+    # Also accept certificates signed by cafile from now on
+    with _lock:
+        _cafiles.append(cafile)
+        _contexts.clear()
+
+def get_stats():
+    with _lock:
+        return dict(stats)
 
 # A wrap_socket implementation that verifies certificates using system
 # CA certificates
@@ -7,10 +46,7 @@ def my_wrap_socket(sock, keyfile=None, certfile=None,
                    do_handshake_on_connect=True,
                    suppress_ragged_eofs=True,
                    server_hostname=None):
-    sslctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-    if keyfile or certfile:
-        sslctx.load_cert_chain(certfile, keyfile)
-    sslctx.verify_mode = ssl.CERT_REQUIRED # Should be default
+    sslctx = get_context(ssl.Purpose.SERVER_AUTH, keyfile, certfile)
     return sslctx.wrap_socket(sock, server_side=False,
                               do_handshake_on_connect=do_handshake_on_connect,
                               suppress_ragged_eofs=suppress_ragged_eofs,
@@ -19,10 +55,17 @@ def my_wrap_socket(sock, keyfile=None, certfile=None,
 # From
 # http://thejosephturner.com/blog/2011/03/19/
 class VerifiedHTTPSConnection(httplib.HTTPSConnection):
+    # Seconds taken by the last connect() to connect, and for the handshake
+    connect_time = None
+    tls_time = None
+
     def connect(self):
         # overrides the version in httplib so that we do
         #    certificate verification
+        start = time.time()
         sock = socket.create_connection((self.host, self.port), self.timeout)
+        connected = time.time()
+        self.connect_time = connected - start
         if self._tunnel_host:
             self.sock = sock
             self._tunnel()
@@ -31,6 +74,7 @@ class VerifiedHTTPSConnection(httplib.HTTPSConnection):
         #ca = ssl.get_server_certificate((host, port),
         #    ssl_version=ssl.PROTOCOL_SSLv3|ssl.PROTOCOL_TLSv1)
         self.sock = my_wrap_socket(sock, server_hostname=self.host)
+        self.tls_time = time.time() - connected
 
 # wraps https connections with ssl certificate verification
 class VerifiedHTTPSHandler(urllib2.HTTPSHandler):
@@ -0,0 +1,89 @@
+import logging
+
+import os, json
+import threading
+import time
+
+class StateCache(object):
+    """The last known state of each account, kept across restarts so that
+    counts can be shown before the first check of each account finishes.
+
+    Changes are written out together, at most every DELAY seconds, by
+    replacing the file atomically."""
+
+    DELAY = 10
+
+    def __init__(self, path=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}       # Account name -> dict
+        self._timer = None
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except IOError:
+            return      # First start
+        except ValueError:
+            self.log.warning("Ignoring corrupt state cache %s" % (self.path,))
+            return
+        with self.lock:
+            self.entries = entries
+
+    def restore(self, account):
+        # Show the account's last known count until it has been checked
+        with self.lock:
+            entry = self.entries.get(account.name)
+        if entry and entry.get('count') is not None:
+            account.restore(entry)
+
+    def record(self, account):
+        # May be called from any thread
+        with self.lock:
+            entry = self.entries.setdefault(account.name, {})
+            if account.error:
+                entry['error'] = account.error
+                entry['failed'] = time.time()
+            else:
+                entry.pop('error', None)
+                entry.pop('failed', None)
+                entry['count'] = account.count
+                entry['counts'] = account.counts
+                entry['checked'] = time.time()
+            entry.update(account.cache_state())
+            if self.path and not self._timer:
+                self._timer = threading.Timer(self.DELAY, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def forget(self, name):
+        # The account has been removed, or its settings changed
+        with self.lock:
+            if self.entries.pop(name, None) is None:
+                return
+            if self.path and not self._timer:
+                self._timer = threading.Timer(self.DELAY, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self.path:
+                return
+            data = json.dumps(self.entries)
+        # Replace atomically, so that a crash leaves the old or new state
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            self.log.exception("Unable to save state cache")
@@ -0,0 +1,716 @@
+#!/usr/bin/env python
+
+"""multiowl_bench - Benchmarks for multiowl, printed as JSON lines.
+
+The imap, atom and jmap benchmarks check accounts against the local stand-in
+servers of multiowl_fakeservers, run in a separate process so that they do
+not count towards CPU time, memory or threads."""
+
+import os, sys, time, json, argparse
+import logging
+import threading, subprocess, tempfile
+import resource
+from collections import OrderedDict
+import multiowl
+from multiowl import config as configmgr
+from multiowl import metrics, sslutils
+from multiowl.account import Account
+from multiowl.account.imap import AccountIMAP
+from multiowl.account.gmail import AccountGmailAtom
+from multiowl.account.jmap import AccountJMAP
+from multiowl.scheduler import Scheduler
+
+class BenchAccount(Account):
+    def check(self):
+        return self.count
+
+class BenchIcon(multiowl.MailIconBase):
+    """A MailIconBase that renders nothing, and updates only when asked."""
+    def __init__(self, app):
+        super(BenchIcon, self).__init__(app)
+        self.renders = 0
+        self.rendered = {}      # Account name -> (time, count)
+    def refresh_tooltip(self, heading, accounts):
+        self.tooltip = '\n'.join([heading] + accounts)
+    def refresh_display(self):
+        pass
+    def refresh_account_icon(self, account):
+        self.renders += 1
+        self.rendered[account.name] = (time.time(), account.count)
+    def check_obsolete_timer(self, interval):
+        pass
+    def cycle_timer(self, interval):
+        pass
+    def schedule_update(self):
+        pass
+
+class BenchPasswords(dict):
+    """Stands in for the keyring."""
+    def prefetch(self, username):
+        self[username] = 'password'
+
+class BenchApp(object):
+    _loop = None    # Shared by all runs, since its threads never exit
+
+    def __init__(self, engine='thread'):
+        self.accounts = {}
+        self.accountnames = []
+        self.passwords = BenchPasswords()
+        self.scheduler = Scheduler()
+        self.scheduler.STAGGER = 0     # Measure checks, not the staggering
+        self.loop = None
+        if engine == 'loop':
+            from multiowl.eventloop import CheckerLoop
+            if not BenchApp._loop:
+                BenchApp._loop = CheckerLoop()
+            self.loop = BenchApp._loop
+
+    def count_changed(self, account):
+        pass
+
+    def add_account(self, icon, account_class, config):
+        account = account_class(config, icon)
+        self.accounts[account.name] = account
+        self.accountnames.append(account.name)
+        return account
+
+class FakeServers(object):
+    """The multiowl_fakeservers process."""
+    def __init__(self, args, size=None, unseen=None, capabilities=None):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'multiowl_fakeservers.py')
+        self.process = subprocess.Popen(
+            [sys.executable, script, '--latency', str(args.latency),
+             '--size', str(size or args.size),
+             '--unseen', str(args.unseen if unseen is None else unseen),
+             '--capabilities', capabilities or args.capabilities],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        info = self._read()
+        self.imap_port = info['imap']
+        self.atom_port = info['atom']
+        self.jmap_port = info['jmap']
+        sslutils.trust(info['certfile'])
+
+    def _read(self):
+        return json.loads(self.process.stdout.readline())
+
+    def command(self, command):
+        self.process.stdin.write(command + '\n')
+        self.process.stdin.flush()
+        return self._read()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] \
+        if values else None
+
+def pump(icon, done, timeout):
+    # Run the icon's updates on this (the main) thread, once per frame,
+    # until done() or the timeout; returns whether done
+    deadline = time.time() + timeout
+    while not done():
+        if time.time() > deadline:
+            return False
+        time.sleep(icon.FRAME / 1000.)
+        if icon._update_pending:
+            icon.update()
+    return True
+
+def traffic(accounts):
+    # Bytes each way, and how much of that was compressed to how much
+    result = dict.fromkeys(['bytes_in', 'bytes_out', 'wire_in', 'wire_out',
+                            'plain_in', 'plain_out'], 0)
+    for account in accounts:
+        snapshot = account.metrics.snapshot()
+        result['bytes_in'] += snapshot['bytes_in']
+        result['bytes_out'] += snapshot['bytes_out']
+        for key, value in snapshot['compression'].items():
+            result[key] += value
+    return result
+
+def process_stats(app, start_cpu):
+    result = {'cpu_seconds': cpu_time() - start_cpu,
+              'rss': metrics.rss(),
+              'threads': threading.active_count()}
+    if app.loop:
+        result['tasks'] = app.loop.stats()
+    return result
+
+def bench_update(num_accounts, args, bursts=20):
+    # Change every account's count once per burst, as a storm of
+    # notifications from checker threads would, then run the update
+    app = BenchApp()
+    icon = BenchIcon(app)
+    for i in range(num_accounts):
+        account = app.add_account(icon, BenchAccount,
+                                  {'name': 'account%d' % (i,),
+                                   'interval': 300})
+        account.icondata = icon._account_data_class(account, {})
+    icon.update()
+    icon.renders = 0
+    start = time.time()
+    for burst in range(bursts):
+        for name in app.accountnames:
+            app.accounts[name].count = burst
+        icon.update()
+    elapsed = time.time() - start
+    # Then frames in which a single account changed, which should cost
+    # the same however many accounts there are
+    start = time.time()
+    for burst in range(bursts):
+        app.accounts[app.accountnames[burst % num_accounts]].count = burst
+        icon.update()
+    single = (time.time() - start) / bursts
+    return {'benchmark': 'update', 'accounts': num_accounts,
+            'notifications': num_accounts * bursts, 'updates': bursts,
+            'renders': icon.renders, 'seconds': elapsed,
+            'notifications_per_sec': num_accounts * bursts / elapsed,
+            'single_update_seconds': single}
+
+def png_to_pixbuf(surface):
+    # How badges were converted before the badge cache: through a PNG
+    import gtk
+    from StringIO import StringIO
+    png = StringIO()
+    surface.write_to_png(png)
+    loader = gtk.gdk.PixbufLoader()
+    loader.write(png.getvalue())
+    loader.close()
+    return loader.get_pixbuf()
+
+def bench_badges(num_accounts, args):
+    # Render a badge for each account, with a label no other account has
+    # (as when every count changed), converting it through a PNG as before
+    # and directly as now; then look them all up again in the badge cache
+    try:
+        import gtk
+        from multiowl import gtkinterface
+    except ImportError as e:
+        return {'benchmark': 'badges', 'accounts': num_accounts,
+                'error': str(e)}
+    base = gtk.gdk.pixbuf_new_from_file_at_size('mail.svg', args.icon_size,
+                                                args.icon_size)
+    colors = [(1, 0, 0), (0, 0, 1), (0, 0.5, 0), (1, 1, 0)]
+    badges = [(colors[i % len(colors)], i) for i in range(num_accounts)]
+    result = {'benchmark': 'badges', 'accounts': num_accounts,
+              'icon_size': args.icon_size}
+    for name, convert in (('png', png_to_pixbuf),
+                          ('direct', gtkinterface.surface_to_pixbuf)):
+        drawing = converting = 0
+        for round in range(args.rounds):
+            for color, label in badges:
+                start = time.time()
+                surface = gtkinterface.draw_badge(base, color, label)
+                drawn = time.time()
+                convert(surface)
+                drawing += drawn - start
+                converting += time.time() - drawn
+        renders = args.rounds * num_accounts
+        result[name + '_render_ms'] = (drawing + converting) * 1000 / renders
+        result[name + '_convert_ms'] = converting * 1000 / renders
+    cache = gtkinterface.BadgeCache(max(num_accounts,
+                                        gtkinterface.BadgeCache.SIZE))
+    for color, label in badges:
+        cache.get(base, color, label)
+    start = time.time()
+    for round in range(args.rounds):
+        for color, label in badges:
+            cache.get(base, color, label)
+    result['cached_ms'] = (time.time() - start) * 1000 / \
+        (args.rounds * num_accounts)
+    result['cache'] = cache.stats()
+    return result
+
+def bench_imap(num_accounts, args):
+    # Start IMAP accounts on the chosen engine until each shows its count,
+    # then deliver new mail to every mailbox and time how long it takes
+    # for IDLE to bring it to the icon
+    servers = args.servers
+    app = BenchApp(args.engine)
+    icon = BenchIcon(app)
+    start_cpu = cpu_time()
+    start = time.time()
+    for i in range(num_accounts):
+        account = app.add_account(icon, AccountIMAP, {
+            'name': 'imap%d' % (i,), 'interval': 300,
+            'server': 'localhost', 'port': servers.imap_port,
+            'username': 'user%d-%s' % (i, start)})
+        icon.add_account(account, {})
+    expected = [args.unseen]
+    def done():
+        return all(icon.rendered.get(name, (0, None))[1] == expected[0]
+                   for name in app.accountnames)
+    ready = pump(icon, done, args.timeout)
+    startup = time.time() - start
+    # Deliver only once every account is waiting in IDLE
+    deadline = time.time() + args.timeout
+    while ready and servers.command('stats')['imap_idling'] < num_accounts:
+        ready = time.time() < deadline
+        time.sleep(0.1)
+    latencies = []
+    for round in range(args.rounds if ready else 0):
+        expected[0] += 1
+        delivered = servers.command('deliver')['delivered']
+        if not pump(icon, done, args.timeout):
+            ready = False
+            break
+        latencies.extend(icon.rendered[name][0] - delivered
+                         for name in app.accountnames)
+    result = {'benchmark': 'imap', 'accounts': num_accounts,
+              'engine': args.engine, 'latency': args.latency,
+              'complete': ready, 'startup_seconds': startup,
+              'checks_per_sec': num_accounts / startup,
+              'update_latency_p50': percentile(latencies, 0.5),
+              'update_latency_p95': percentile(latencies, 0.95),
+              'update_latency_max': max(latencies) if latencies else None,
+              'errors': sum(sum(app.accounts[name].metrics.snapshot()
+                                ['errors'].values())
+                            for name in app.accountnames)}
+    result.update(traffic(app.accounts.values()))
+    result.update(process_stats(app, start_cpu))
+    for name in app.accountnames:
+        app.accounts[name].stop()
+    return result
+
+# Bytes per check that more unseen messages may add with ESEARCH
+CHECK_SLACK = 32
+
+# Seconds a stalled check may take to be aborted beyond its deadline and
+# the watchdog's interval, e.g. for starting up
+STALL_SLACK = 1
+
+def bench_check(num_accounts, args):
+    # Poll IMAP accounts with check() against mailboxes with more and more
+    # unseen messages, with and without ESEARCH; with it, the bytes read
+    # and memory used per check should not grow with the unseen count
+    levels = []
+    for esearch in (True, False):
+        capabilities = [x for x in args.capabilities.split()
+                        if x != 'ESEARCH'] + (['ESEARCH'] if esearch else [])
+        for unseen in args.unseen_levels:
+            servers = FakeServers(args, size=max(args.size, unseen),
+                                  unseen=unseen,
+                                  capabilities=' '.join(capabilities))
+            app = BenchApp()
+            icon = BenchIcon(app)
+            accounts = [app.add_account(icon, AccountIMAP, {
+                'name': 'check%d' % (i,), 'interval': 300,
+                'server': 'localhost', 'port': servers.imap_port,
+                'username': 'user%d-%s' % (i, time.time())})
+                for i in range(num_accounts)]
+            try:
+                for account in accounts:
+                    account.check()     # Warm up, e.g. the SSL context
+                before = traffic(accounts)['bytes_in']
+                rss = metrics.rss()
+                start = time.time()
+                for round in range(args.rounds):
+                    for account in accounts:
+                        if account.check() != unseen:
+                            raise AssertionError("Wrong count")
+                elapsed = time.time() - start
+                checks = args.rounds * num_accounts
+                levels.append({
+                    'esearch': esearch, 'unseen': unseen,
+                    'bytes_in_per_check':
+                    (traffic(accounts)['bytes_in'] - before) / checks,
+                    'rss_growth': metrics.rss() - rss,
+                    'seconds_per_check': elapsed / checks})
+            finally:
+                for account in accounts:
+                    account.stop()
+                servers.close()
+    # With ESEARCH, no level may read more than the fewest unseen did,
+    # give or take the digits of the count
+    fewest = min(args.unseen_levels)
+    base = [level['bytes_in_per_check'] for level in levels
+            if level['esearch'] and level['unseen'] == fewest][0]
+    constant = all(level['bytes_in_per_check'] <= base + CHECK_SLACK
+                   for level in levels if level['esearch'])
+    result = {'benchmark': 'check', 'accounts': num_accounts,
+              'latency': args.latency, 'levels': levels,
+              'constant': constant}
+    if not constant:
+        result['failed'] = "bytes per check grew with the unseen count"
+    return result
+
+def bench_stall(num_accounts, args):
+    # Check IMAP accounts with one-second deadlines against a server that
+    # stalls in each phase in turn, and time how long it takes for every
+    # check to be aborted; it fails if that takes longer than the deadline
+    # of the phase, plus the time the watchdog may take to notice and
+    # STALL_SLACK. The socket timeout for reads (--timeout) is far longer.
+    import multiowl_fakeservers
+    certfile = multiowl_fakeservers.make_certificate()
+    sslutils.trust(certfile)
+    timeouts = dict.fromkeys(Account.TIMEOUTS, 1)
+    timeouts['io'] = args.timeout
+    interval = 1
+    # Connecting, the TLS handshake and the greeting share one deadline
+    limits = dict((phase, timeouts[phase]) for phase in
+                  ('login', 'select', 'search'))
+    limits.update(dict.fromkeys(('connect', 'tls', 'greeting'),
+                                timeouts['greeting'] + timeouts['connect'] +
+                                timeouts['tls']))
+    limits['idle'] = timeouts['idle'] + interval
+    phases = {}
+    for phase in multiowl_fakeservers.STALL_PHASES:
+        # Without IDLE, the count comes from a search
+        server = multiowl_fakeservers.FakeIMAPServer(
+            certfile, capabilities=[] if phase == 'search' else ['IDLE'],
+            stall=phase).start()
+        app = BenchApp(args.engine)
+        app.scheduler.STAGGER = 0   # Start every account at once
+        limit = limits[phase] + app.scheduler.WATCHDOG_INTERVAL + STALL_SLACK
+        icon = BenchIcon(app)
+        accounts = []
+        start = time.time()
+        for i in range(num_accounts):
+            account = app.add_account(icon, AccountIMAP, {
+                'name': 'stall%d' % (i,), 'interval': interval,
+                'server': 'localhost', 'port': server.port,
+                'username': 'user%d-%s' % (i, start)})
+            account.TIMEOUTS = timeouts
+            icon.add_account(account, {})
+            accounts.append(account)
+        failed = {}
+        deadline = start + args.timeout + 5
+        while len(failed) < num_accounts and time.time() < deadline:
+            for account in accounts:
+                if account.error and account.name not in failed:
+                    failed[account.name] = time.time() - start
+            time.sleep(0.05)
+        # Accounts queue behind the per-host connection limit, so time each
+        # one from its own connection attempt rather than from the start.
+        for account in accounts:
+            events = account.recorder.snapshot()
+            errors = [t for t, event, detail in events if event == 'error']
+            if account.name in failed and errors:
+                connects = [t for t, event, detail in events
+                            if event == 'connect' and t <= errors[0]]
+                if connects:
+                    failed[account.name] = errors[0] - connects[-1]
+        phases[phase] = {
+            'aborted': len(failed) == num_accounts and
+            max(failed.values()) <= limit,
+            'seconds_max': max(failed.values()) if failed else None,
+            'seconds_limit': limit,
+            'deadlines': sorted(set(detail for account in accounts
+                                    for t, event, detail
+                                    in account.recorder.snapshot()
+                                    if event == 'deadline')),
+            'errors': sorted(set(account.error.split(':')[0]
+                                 for account in accounts if account.error))}
+        for account in accounts:
+            account.stop()
+        if phase != 'connect':
+            server.shutdown()
+        server.server_close()
+    missed = sorted(phase for phase, result in phases.items()
+                    if not result['aborted'])
+    result = {'benchmark': 'stall', 'accounts': num_accounts,
+              'engine': args.engine, 'io_timeout': args.timeout,
+              'complete': not missed, 'phases': phases}
+    if missed:
+        result['failed'] = "not aborted in time: %s" % (', '.join(missed),)
+    return result
+
+# Capabilities of the server for each way the sync benchmark keeps up:
+# searching again, CONDSTORE, QRESYNC, and QRESYNC with NOTIFY
+SYNC_CAPABILITIES = ('IDLE', 'IDLE CONDSTORE', 'IDLE CONDSTORE QRESYNC',
+                     'IDLE CONDSTORE QRESYNC NOTIFY ESEARCH')
+
+def first_uid(mailbox, seen):
+    with mailbox.lock:
+        return [message[0] for message in mailbox.messages
+                if message[1] == seen][0]
+
+def bench_sync(num_accounts, args):
+    # Change the mailboxes of IMAP accounts watching INBOX and Lists as
+    # other clients would, and time how long it takes for the accounts'
+    # counts and inbox UIDs to match; then change them while the accounts
+    # are stopped, and check that new accounts resynchronise from the saved
+    # mailbox state. It fails if any step is not caught up with in
+    # --timeout, or if QRESYNC did not report the messages expunged meanwhile.
+    import multiowl_fakeservers
+    certfile = multiowl_fakeservers.make_certificate()
+    sslutils.trust(certfile)
+    steps = [
+        ('deliver', lambda inbox, lists: inbox.deliver()),
+        ('read', lambda inbox, lists:
+         inbox.set_seen(first_uid(inbox, False))),
+        ('unread', lambda inbox, lists:
+         inbox.set_seen(first_uid(inbox, True), False)),
+        ('expunge', lambda inbox, lists:
+         inbox.expunge(first_uid(inbox, False))),
+        ('deliver to Lists', lambda inbox, lists: lists.deliver()),
+        ('read in Lists', lambda inbox, lists:
+         lists.set_seen(first_uid(lists, False))),
+    ]
+    def offline(inbox, lists):
+        inbox.deliver()
+        inbox.expunge(first_uid(inbox, False))
+        inbox.set_seen(first_uid(inbox, False))
+        inbox.set_seen(first_uid(inbox, True), False)
+    results = {}
+    for capabilities in SYNC_CAPABILITIES:
+        server = multiowl_fakeservers.FakeIMAPServer(
+            certfile, args.latency, args.size, args.unseen,
+            capabilities.split()).start()
+        app = BenchApp(args.engine)
+        app.scheduler.STAGGER = 0
+        icon = BenchIcon(app)
+        users = ['sync%d-%s' % (i, time.time()) for i in range(num_accounts)]
+        for user in users:
+            server.folder(user, 'Lists', size=10, unseen=2)
+        def start_accounts(suffix):
+            accounts = []
+            for i, user in enumerate(users):
+                account = app.add_account(icon, AccountIMAP, {
+                    'name': 'sync%d%s' % (i, suffix), 'interval': 2,
+                    'server': 'localhost', 'port': server.port,
+                    'username': user, 'mailboxes': 'INBOX, Lists'})
+                icon.add_account(account, {})
+                accounts.append(account)
+            return accounts
+        def synced():
+            for account, user in zip(accounts, users):
+                inbox = server.mailbox(user)
+                lists = server.folder(user, 'Lists')
+                with inbox.lock:
+                    with lists.lock:
+                        expected = {'INBOX': inbox.unseen(),
+                                    'Lists': lists.unseen()}
+                if account.counts != expected or \
+                   list(account._state.uids) != inbox.uids():
+                    return False
+            return True
+        def run(name, change):
+            start = time.time()
+            if change:
+                for user in users:
+                    change(server.mailbox(user), server.folder(user, 'Lists'))
+            timings[name] = time.time() - start \
+                if pump(icon, synced, args.timeout) else None
+        timings = OrderedDict()
+        accounts = start_accounts('')
+        run('start', None)
+        for name, change in steps:
+            run(name, change)
+        for account in accounts:
+            account.stop()
+        for user in users:
+            offline(server.mailbox(user), server.folder(user, 'Lists'))
+        accounts = start_accounts('-again')
+        run('resync', None)
+        # With QRESYNC, the messages expunged meanwhile come with the
+        # EXAMINE response
+        vanished = all(any(event == 'untagged' and 'VANISHED (EARLIER)' in
+                           detail for t, event, detail
+                           in account.recorder.snapshot())
+                       for account in accounts)
+        for account in accounts:
+            account.stop()
+        server.shutdown()
+        server.server_close()
+        results[capabilities] = {
+            'seconds': timings,
+            'caught_up': all(x is not None for x in timings.values()),
+            'vanished_earlier': vanished}
+    missed = ['%s: %s' % (capabilities, ', '.join(
+        name for name, seconds in result['seconds'].items()
+        if seconds is None) or 'no VANISHED (EARLIER)')
+        for capabilities, result in sorted(results.items())
+        if not result['caught_up'] or
+        'QRESYNC' in capabilities and not result['vanished_earlier']]
+    result = {'benchmark': 'sync', 'accounts': num_accounts,
+              'engine': args.engine, 'latency': args.latency,
+              'complete': not missed, 'servers': results}
+    if missed:
+        result['failed'] = "not caught up with %s" % ('; '.join(missed),)
+    return result
+
+def bench_atom(num_accounts, args):
+    # Check Atom feed accounts on a pool of threads: one round of full
+    # fetches, then rounds where nothing changed (304 Not Modified)
+    servers = args.servers
+    app = BenchApp()
+    icon = BenchIcon(app)
+    host = 'localhost:%d' % (servers.atom_port,)
+    accounts = []
+    for i in range(num_accounts):
+        account = app.add_account(icon, AccountGmailAtom, {
+            'name': 'atom%d' % (i,), 'interval': 300,
+            'username': 'user%d-%s@example.com' % (i, time.time())})
+        account.HOST = host
+        account.icondata = icon._account_data_class(account, {})
+        accounts.append(account)
+
+    def run_round():
+        pending = list(accounts)
+        lock = threading.Lock()
+        def work():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    account = pending.pop()
+                try:
+                    account.count = account.check()
+                except Exception as e:
+                    account.metrics.error(e)
+                    account.count = '?'
+        start = time.time()
+        threads = [threading.Thread(target=work)
+                   for i in range(min(args.workers, num_accounts))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        icon.update()
+        return time.time() - start
+
+    start_cpu = cpu_time()
+    full = run_round()
+    conditional = [run_round() for i in range(args.rounds)]
+    result = {'benchmark': 'atom', 'accounts': num_accounts,
+              'workers': args.workers, 'latency': args.latency,
+              'full_checks_per_sec': num_accounts / full,
+              'conditional_checks_per_sec':
+              num_accounts * len(conditional) / sum(conditional),
+              'errors': sum(sum(account.metrics.snapshot()['errors']
+                                .values()) for account in accounts),
+              'bytes_in': sum(account.metrics.snapshot()['bytes_in']
+                              for account in accounts)}
+    result.update(process_stats(app, start_cpu))
+    for account in accounts:
+        account.stop()
+    return result
+
+def bench_jmap(num_accounts, args):
+    # Start JMAP accounts on the chosen engine until each shows its count,
+    # then deliver new mail to every account and time how long it takes for
+    # the push channel to bring it to the icon
+    servers = args.servers
+    app = BenchApp(args.engine)
+    icon = BenchIcon(app)
+    start_cpu = cpu_time()
+    start = time.time()
+    for i in range(num_accounts):
+        account = app.add_account(icon, AccountJMAP, {
+            'name': 'jmap%d' % (i,), 'interval': 300,
+            'url': 'https://localhost:%d/.well-known/jmap' %
+            (servers.jmap_port,),
+            'username': 'user%d-%s' % (i, start)})
+        icon.add_account(account, {})
+    expected = [args.unseen]
+    def done():
+        return all(icon.rendered.get(name, (0, None))[1] == expected[0]
+                   for name in app.accountnames)
+    ready = pump(icon, done, args.timeout)
+    startup = time.time() - start
+    deadline = time.time() + args.timeout
+    while ready and servers.command('stats')['jmap_listening'] < num_accounts:
+        ready = time.time() < deadline
+        time.sleep(0.1)
+    latencies = []
+    for round in range(args.rounds if ready else 0):
+        expected[0] += 1
+        delivered = servers.command('deliver')['delivered']
+        if not pump(icon, done, args.timeout):
+            ready = False
+            break
+        latencies.extend(icon.rendered[name][0] - delivered
+                         for name in app.accountnames)
+    result = {'benchmark': 'jmap', 'accounts': num_accounts,
+              'engine': args.engine, 'latency': args.latency,
+              'complete': ready, 'startup_seconds': startup,
+              'checks_per_sec': num_accounts / startup,
+              'update_latency_p50': percentile(latencies, 0.5),
+              'update_latency_p95': percentile(latencies, 0.95),
+              'update_latency_max': max(latencies) if latencies else None,
+              'errors': sum(sum(app.accounts[name].metrics.snapshot()
+                                ['errors'].values())
+                            for name in app.accountnames)}
+    result.update(traffic(app.accounts.values()))
+    result.update(process_stats(app, start_cpu))
+    for name in app.accountnames:
+        app.accounts[name].stop()
+    return result
+
+BENCHMARKS = {'update': bench_update, 'imap': bench_imap, 'atom': bench_atom,
+              'jmap': bench_jmap, 'check': bench_check,
+              'badges': bench_badges, 'stall': bench_stall,
+              'sync': bench_sync}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help="one of: %s (default: all)" %
+                        (', '.join(sorted(BENCHMARKS)),))
+    parser.add_argument('--accounts', type=int, nargs='+',
+                        default=[1, 10, 100, 1000])
+    parser.add_argument('--engine', choices=('thread', 'loop'),
+                        default='thread')
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds the fake servers delay every reply")
+    parser.add_argument('--size', type=int, default=100,
+                        help="messages in each IMAP mailbox")
+    parser.add_argument('--unseen', type=int, default=10)
+    parser.add_argument('--unseen-levels', type=int, nargs='+',
+                        default=[10, 1000, 50000],
+                        help="unseen messages in each mailbox for the check "
+                        "benchmark")
+    parser.add_argument('--capabilities', default='IDLE',
+                        help="IMAP server capabilities")
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--icon-size', type=int, default=48,
+                        help="pixels of the badges rendered")
+    parser.add_argument('--workers', type=int, default=16,
+                        help="threads checking Atom feeds")
+    parser.add_argument('--timeout', type=float, default=120,
+                        help="seconds to wait for the accounts each round")
+    parser.add_argument('--assert', dest='strict', action='store_true',
+                        help="exit with an error if a result shows a "
+                        "regression, e.g. the check benchmark's bytes per "
+                        "check growing with the unseen count")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % (name,))
+    args.benchmarks = args.benchmarks or sorted(BENCHMARKS)
+    logging.basicConfig(level=logging.ERROR)
+
+    # Each account has a connection, and keeps its mailbox state in the cache
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    configmgr.CACHE_DIR = tempfile.mkdtemp(prefix='multiowl-bench-')
+    args.servers = None
+    if set(args.benchmarks) & set(['imap', 'atom', 'jmap']):
+        args.servers = FakeServers(args)
+    failed = []
+    try:
+        for name in args.benchmarks:
+            for num_accounts in args.accounts:
+                result = BENCHMARKS[name](num_accounts, args)
+                print json.dumps(result, sort_keys=True)
+                sys.stdout.flush()
+                if result.get('failed'):
+                    failed.append('%s at %d accounts: %s' %
+                                  (name, num_accounts, result['failed']))
+    finally:
+        if args.servers:
+            args.servers.close()
+    if args.strict and failed:
+        sys.exit('\n'.join(failed))
+
+if __name__ == '__main__':
+    main()
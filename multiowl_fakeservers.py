@@ -0,0 +1,828 @@
+#!/usr/bin/env python
+
+"""multiowl_fakeservers - Local stand-ins for the mail servers multiowl
+talks to, for benchmarks and scale tests: an IMAP4 server with IDLE, a
+Gmail-style Atom feed server, and a JMAP server with an EventSource push
+channel, all over TLS with a throwaway certificate.
+Every reply can be delayed to simulate a distant server, and the IMAP
+server can stall in any phase of a session to simulate a hung one."""
+
+import os, sys, re, ssl, socket, subprocess, tempfile
+import argparse, json
+import threading, time, base64, zlib
+import SocketServer, BaseHTTPServer, Queue
+
+# JMAP capabilities (RFC 8620, RFC 8621)
+CORE = 'urn:ietf:params:jmap:core'
+MAIL = 'urn:ietf:params:jmap:mail'
+
+def make_certificate(directory=None):
+    # A self-signed certificate for localhost, in one PEM file with its key
+    directory = directory or tempfile.mkdtemp(prefix='multiowl-')
+    path = os.path.join(directory, 'localhost.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['openssl', 'req', '-x509', '-nodes',
+                               '-newkey', 'rsa:2048', '-days', '1',
+                               '-subj', '/CN=localhost',
+                               '-addext', 'subjectAltName=DNS:localhost',
+                               '-keyout', path, '-out', path],
+                              stdout=devnull, stderr=devnull)
+    return path
+
+def quote(name):
+    return '"%s"' % (re.sub(r'(["\\])', r'\\\1', name),)
+
+def unquote(name):
+    if name.startswith('"'):
+        return re.sub(r'\\(.)', r'\1', name[1:-1])
+    return name
+
+class FakeMailbox(object):
+    """Messages as [uid, seen, modseq], the UIDs expunged with the MODSEQ
+    of each expunge, the sessions that have the mailbox selected, to tell
+    about changes to it, and those to send STATUS to for NOTIFY."""
+    def __init__(self, size=100, unseen=10, name='INBOX'):
+        self.name = name
+        self.lock = threading.Lock()
+        self.uidvalidity = 1
+        self.modseq = 1
+        self.messages = [[uid, uid <= size - unseen, 1]
+                         for uid in range(1, size + 1)]
+        self.next_uid = size + 1
+        self.expunged = []      # (uid, modseq)
+        self.sessions = []
+        self.notified = []
+
+    def unseen(self):
+        return sum(1 for message in self.messages if not message[1])
+
+    def uids(self):
+        with self.lock:
+            return [message[0] for message in self.messages]
+
+    def deliver(self):
+        # A new unseen message
+        with self.lock:
+            self.modseq += 1
+            self.messages.append([self.next_uid, False, self.modseq])
+            self.next_uid += 1
+            self._push('* %d EXISTS' % (len(self.messages),))
+            self._notify()
+
+    def set_seen(self, uid, seen=True):
+        # Another client marking a message read or unread
+        with self.lock:
+            seq = self._seq(uid)
+            self.modseq += 1
+            message = self.messages[seq - 1]
+            message[1:] = [seen, self.modseq]
+            self._push('* %d FETCH (UID %d FLAGS (%s) MODSEQ (%d))' %
+                       (seq, uid, '\\Seen' if seen else '', self.modseq))
+            # As some servers do, leave the unseen count out of STATUS
+            # responses about flag changes
+            self._notify(unseen=False)
+
+    def expunge(self, uid):
+        # Another client deleting a message
+        with self.lock:
+            seq = self._seq(uid)
+            del self.messages[seq - 1]
+            self.modseq += 1
+            self.expunged.append((uid, self.modseq))
+            self._push('* %d EXPUNGE' % (seq,), '* VANISHED %d' % (uid,))
+            self._notify()
+
+    def status(self, unseen=True):
+        # Call with the lock held
+        items = 'MESSAGES %d UIDNEXT %d' % (len(self.messages), self.next_uid)
+        if unseen:
+            items += ' UNSEEN %d' % (self.unseen(),)
+        return '* STATUS %s (%s)' % (quote(self.name), items)
+
+    def _seq(self, uid):
+        # Call with the lock held
+        for seq, message in enumerate(self.messages, 1):
+            if message[0] == uid:
+                return seq
+        raise KeyError(uid)
+
+    def _push(self, line, vanished=None):
+        # Call with the lock held; sessions that enabled QRESYNC are told
+        # about expunges with VANISHED instead
+        for session in list(self.sessions):
+            session.tell(vanished if vanished and session.qresync else line)
+
+    def _notify(self, unseen=True):
+        # Call with the lock held
+        for session in list(self.notified):
+            session.tell(self.status(unseen))
+
+class InflatingReader(object):
+    """Reads the client's side of a COMPRESS=DEFLATE connection."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buf = ''
+
+    def readline(self):
+        while '\n' not in self.buf:
+            data = self.sock.recv(4096)
+            if not data:
+                break
+            self.buf += self.decompressor.decompress(data)
+        end = self.buf.find('\n') + 1 or len(self.buf)
+        line, self.buf = self.buf[:end], self.buf[end:]
+        return line
+
+    def close(self):
+        pass
+
+# Phases of an IMAP session the server can be told to stall in, never
+# answering, and the commands that start them
+STALL_PHASES = ('connect', 'tls', 'greeting', 'login', 'select', 'search',
+                'idle')
+STALL_COMMANDS = {'login': ('LOGIN',), 'select': ('SELECT', 'EXAMINE'),
+                  'search': ('SEARCH', 'UID SEARCH'), 'idle': ('IDLE',)}
+
+class FakeIMAPHandler(SocketServer.StreamRequestHandler):
+    def setup(self):
+        if self.server.stall == 'tls':
+            self.stall()
+        if self.server.certfile:
+            self.request = ssl.wrap_socket(self.request, server_side=True,
+                                           certfile=self.server.certfile)
+        SocketServer.StreamRequestHandler.setup(self)
+        self.write_lock = threading.Lock()
+        self.compressor = None
+        # Untagged responses about changes, sent at once while idling and
+        # otherwise with the next command's response
+        self.tell_lock = threading.Lock()
+        self.idle = False
+        self.pending = []
+        self.qresync = False
+        self.user = None
+        self.mailbox = None     # The selected one
+        self.notifying = []     # Mailboxes NOTIFY was set for
+
+    def reply(self, *lines):
+        data = ''.join(line + '\r\n' for line in lines)
+        with self.write_lock:
+            if self.compressor:
+                data = self.compressor.compress(data) + \
+                    self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def stall(self):
+        # Answer nothing until the client goes away
+        try:
+            while self.request.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def tell(self, line):
+        with self.tell_lock:
+            if not self.idle:
+                self.pending.append(line)
+                return
+            try:
+                self.reply(line)
+            except Exception:
+                pass    # The client went away
+
+    def flush(self):
+        with self.tell_lock:
+            pending, self.pending = self.pending, []
+            if pending:
+                self.reply(*pending)
+
+    def handle(self):
+        try:
+            self._handle()
+        except socket.error:
+            pass        # The client went away; ssl.SSLError is one too
+        finally:
+            self._select(None)
+            self._notify_set([])
+
+    def _select(self, mailbox):
+        for old in [self.mailbox] if self.mailbox else []:
+            with old.lock:
+                old.sessions.remove(self)
+        self.mailbox = mailbox
+        with self.tell_lock:
+            self.pending = []
+        if mailbox:
+            with mailbox.lock:
+                mailbox.sessions.append(self)
+
+    def _notify_set(self, mailboxes):
+        for mailbox in self.notifying:
+            with mailbox.lock:
+                mailbox.notified.remove(self)
+        self.notifying = mailboxes
+        for mailbox in mailboxes:
+            with mailbox.lock:
+                mailbox.notified.append(self)
+
+    def _handle(self):
+        server = self.server
+        if server.stall in ('tls', 'greeting'):
+            self.stall()
+            return
+        self.reply('* OK fake IMAP server ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.strip().split(' ', 2)
+            parts += [''] * (3 - len(parts))
+            tag, command, args = parts[0], parts[1].upper(), parts[2]
+            if command == 'UID':
+                command, args = (args.split(' ', 1) + [''])[:2]
+                command = 'UID ' + command.upper()
+            server.commands += 1
+            if server.latency:
+                time.sleep(server.latency)
+            if command in STALL_COMMANDS.get(server.stall, ()):
+                self.stall()
+                return
+            # No EXPUNGE may be sent during commands that take sequence
+            # numbers (RFC 3501, 7.4.1); IDLE sends them itself
+            if command not in ('FETCH', 'SEARCH', 'STORE', 'IDLE'):
+                self.flush()
+            handler = getattr(self, 'do_' + command.replace(' ', '_'), None)
+            if not handler:
+                self.reply('%s BAD unknown command' % (tag,))
+            elif handler(tag, args) is False:
+                return
+
+    def do_CAPABILITY(self, tag, args):
+        capabilities = ['IMAP4rev1'] + self.server.capabilities
+        self.reply('* CAPABILITY ' + ' '.join(capabilities),
+                   '%s OK done' % (tag,))
+
+    def do_LOGIN(self, tag, args):
+        self.user = args.split()[0].strip('"')
+        self.server.mailbox(self.user)
+        self.reply('%s OK logged in' % (tag,))
+
+    def do_COMPRESS(self, tag, args):
+        if 'COMPRESS=DEFLATE' not in self.server.capabilities or \
+           self.compressor:
+            self.reply('%s NO [COMPRESSIONACTIVE] not now' % (tag,))
+            return
+        self.reply('%s OK deflate active' % (tag,))
+        with self.write_lock:
+            self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                               zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.rfile = InflatingReader(self.request)
+
+    def do_ENABLE(self, tag, args):
+        enabled = [x for x in args.upper().split()
+                   if x in self.server.capabilities]
+        self.qresync = self.qresync or 'QRESYNC' in enabled
+        self.reply(' '.join(['* ENABLED'] + enabled), '%s OK done' % (tag,))
+
+    def _mailbox_arg(self, args):
+        # The mailbox named at the start of args, if it exists, and the rest
+        match = re.match(r'("(?:[^"\\]|\\.)*"|\S+) ?(.*)', args)
+        mailbox = self.server.folder(self.user, unquote(match.group(1)))
+        return mailbox, match.group(2)
+
+    def do_EXAMINE(self, tag, args):
+        mailbox, args = self._mailbox_arg(args)
+        if not mailbox:
+            self.reply('%s NO no such mailbox' % (tag,))
+            return
+        self._select(mailbox)
+        with mailbox.lock:
+            lines = ['* %d EXISTS' % (len(mailbox.messages),),
+                     '* OK [UIDVALIDITY %d] ok' % (mailbox.uidvalidity,)]
+            if 'CONDSTORE' in self.server.capabilities:
+                lines.append('* OK [HIGHESTMODSEQ %d] ok' % (mailbox.modseq,))
+            match = re.search(r'QRESYNC \((\d+) (\d+)\)', args)
+            if match and self.qresync and \
+               int(match.group(1)) == mailbox.uidvalidity:
+                modseq = int(match.group(2))
+                vanished = [uid for uid, expunged in mailbox.expunged
+                            if expunged > modseq]
+                if vanished:
+                    lines.append('* VANISHED (EARLIER) ' +
+                                 ','.join(map(str, vanished)))
+                lines.extend(self._fetch_lines(modseq))
+        self.reply(*(lines + ['%s OK [READ-ONLY] done' % (tag,)]))
+    do_SELECT = do_EXAMINE
+
+    def _search(self, criteria, uid):
+        with self.mailbox.lock:
+            return [message[0] if uid else seq
+                    for seq, message in enumerate(self.mailbox.messages, 1)
+                    if criteria == 'ALL' or not message[1]]
+
+    def do_SEARCH(self, tag, args, uid=False):
+        match = re.match(r'RETURN \((\w+)\) (.*)', args, re.I)
+        if not match:
+            results = self._search(args.strip('()').upper(), uid)
+            self.reply('* SEARCH ' + ' '.join(map(str, results)),
+                       '%s OK done' % (tag,))
+            return
+        result = match.group(1).upper()
+        results = self._search(match.group(2).strip('()').upper(), uid)
+        line = '* ESEARCH (TAG "%s")%s' % (tag, ' UID' if uid else '')
+        if result == 'COUNT':
+            line += ' COUNT %d' % (len(results),)
+        elif results:
+            line += ' ALL ' + ','.join(map(str, results))
+        self.reply(line, '%s OK done' % (tag,))
+
+    def do_UID_SEARCH(self, tag, args):
+        self.do_SEARCH(tag, args, uid=True)
+
+    def _fetch_lines(self, changedsince=0, first=1, last=None):
+        # Call with the mailbox locked
+        return ['* %d FETCH (UID %d FLAGS (%s) MODSEQ (%d))' %
+                (seq, message[0], '\\Seen' if message[1] else '', message[2])
+                for seq, message in enumerate(self.mailbox.messages, 1)
+                if message[2] > changedsince and first <= seq and
+                (last is None or seq <= last)]
+
+    def do_FETCH(self, tag, args):
+        first, last = args.split()[0].split(':')
+        with self.mailbox.lock:
+            lines = self._fetch_lines(first=int(first),
+                                      last=None if last == '*' else int(last))
+        self.reply(*(lines + ['%s OK done' % (tag,)]))
+
+    def do_UID_FETCH(self, tag, args):
+        match = re.search(r'CHANGEDSINCE (\d+)', args)
+        with self.mailbox.lock:
+            lines = self._fetch_lines(int(match.group(1)) if match else 0)
+        self.reply(*(lines + ['%s OK done' % (tag,)]))
+
+    def do_STATUS(self, tag, args):
+        mailbox, args = self._mailbox_arg(args)
+        if not mailbox:
+            self.reply('%s NO no such mailbox' % (tag,))
+            return
+        with mailbox.lock:
+            line = mailbox.status()
+        self.reply(line, '%s OK done' % (tag,))
+
+    def do_NOTIFY(self, tag, args):
+        # Only the mailboxes of a MAILBOXES filter are told about (RFC 5465)
+        if 'NOTIFY' not in self.server.capabilities:
+            self.reply('%s BAD unknown command' % (tag,))
+            return
+        match = re.search(r'\(MAILBOXES \(([^)]*)\)', args, re.I)
+        names = re.findall(r'"(?:[^"\\]|\\.)*"|\S+',
+                           match.group(1)) if match else []
+        mailboxes = [self.server.folder(self.user, unquote(x)) for x in names]
+        self._notify_set([x for x in mailboxes if x])
+        self.reply('%s OK done' % (tag,))
+
+    def do_NOOP(self, tag, args):
+        self.reply('%s OK done' % (tag,))
+
+    def do_IDLE(self, tag, args):
+        with self.tell_lock:
+            self.idle = True
+            pending, self.pending = self.pending, []
+            self.reply(*(['+ idling'] + pending))
+        self.server.idling(1)
+        try:
+            line = self.rfile.readline()
+        finally:
+            self.server.idling(-1)
+            with self.tell_lock:
+                self.idle = False
+        if not line:
+            return False
+        self.reply('%s OK IDLE terminated' % (tag,))
+
+    def do_LOGOUT(self, tag, args):
+        self.reply('* BYE', '%s OK done' % (tag,))
+        return False
+
+class FakeIMAPServer(SocketServer.ThreadingTCPServer):
+    """An IMAP server on localhost with an inbox per user, created on first
+    login with the given number of messages, and any other folders made
+    with folder()."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, certfile=None, latency=0, size=100, unseen=10,
+                 capabilities=('IDLE',), stall=None):
+        self.stall = stall      # One of STALL_PHASES
+        SocketServer.ThreadingTCPServer.__init__(self, ('localhost', 0),
+                                                 FakeIMAPHandler)
+        self.certfile = certfile
+        self.latency = latency
+        self.size = size
+        self.unseen = unseen
+        self.capabilities = list(capabilities)
+        self.lock = threading.Lock()
+        self.mailboxes = {}     # User -> inbox
+        self.folders = {}       # (User, name) -> other mailbox
+        self.commands = 0
+        self.idlers = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # Clients going away, e.g. when a benchmark ends, is expected
+        if not isinstance(sys.exc_info()[1], socket.error):
+            SocketServer.BaseServer.handle_error(self, request, client_address)
+
+    def mailbox(self, user):
+        with self.lock:
+            if user not in self.mailboxes:
+                self.mailboxes[user] = FakeMailbox(self.size, self.unseen)
+            return self.mailboxes[user]
+
+    def folder(self, user, name, size=None, unseen=0):
+        # The user's mailbox of that name; with a size, one is created if
+        # there is none
+        if name.upper() == 'INBOX':
+            return self.mailbox(user)
+        with self.lock:
+            if (user, name) not in self.folders and size is not None:
+                self.folders[user, name] = FakeMailbox(size, unseen, name)
+            return self.folders.get((user, name))
+
+    def idling(self, change):
+        with self.lock:
+            self.idlers += change
+
+    def server_activate(self):
+        if self.stall != 'connect':
+            SocketServer.ThreadingTCPServer.server_activate(self)
+            return
+        # Fill the accept queue and never accept, so that connecting hangs
+        self.socket.listen(0)
+        self.fillers = []
+        for i in range(2):
+            filler = socket.socket()
+            filler.setblocking(False)
+            filler.connect_ex(self.server_address)
+            self.fillers.append(filler)
+
+    def start(self):
+        if self.stall == 'connect':
+            return self
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='FakeIMAPServer')
+        thread.daemon = True
+        thread.start()
+        return self
+
+FEED = '''<?xml version="1.0" encoding="UTF-8"?>
+<feed version="0.3" xmlns="http://purl.org/atom/ns#">
+<title>Gmail - Inbox for %(user)s</title>
+<tagline>New messages in your Gmail Inbox</tagline>
+<fullcount>%(count)d</fullcount>
+<modified>2015-01-01T00:00:00Z</modified>
+%(entries)s</feed>
+'''
+ENTRY = '''<entry><title>Message %d</title><summary>...</summary>
+<link rel="alternate" href="https://mail.google.com/mail/" type="text/html"/>
+<author><name>Sender</name><email>sender@example.com</email></author>
+</entry>
+'''
+
+class FakeAtomHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        if self.server.certfile:
+            self.request = ssl.wrap_socket(self.request, server_side=True,
+                                           certfile=self.server.certfile)
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        user = base64.b64decode(auth[6:]).split(':', 1)[0]
+        count, version = server.feed(user, self.path)
+        etag = '"%d"' % (version,)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = FEED % {'user': user, 'count': count,
+                       'entries': ''.join(ENTRY % (i,)
+                                          for i in range(min(count, 20)))}
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/atom+xml')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeAtomServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A Gmail-style Atom feed server on localhost, with an unread count and
+    ETag for each user and feed."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, certfile=None, latency=0, unseen=10):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                           FakeAtomHandler)
+        self.certfile = certfile
+        self.latency = latency
+        self.unseen = unseen
+        self.lock = threading.Lock()
+        self.feeds = {}     # (user, path) -> [count, version]
+        self.requests = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # Clients going away, e.g. when a benchmark ends, is expected
+        if not isinstance(sys.exc_info()[1], socket.error):
+            SocketServer.BaseServer.handle_error(self, request, client_address)
+
+    def feed(self, user, path):
+        with self.lock:
+            return tuple(self.feeds.setdefault((user, path),
+                                               [self.unseen, 1]))
+
+    def deliver(self, user, path):
+        # A new unread message, changing the feed's ETag
+        with self.lock:
+            feed = self.feeds.setdefault((user, path), [self.unseen, 1])
+            feed[0] += 1
+            feed[1] += 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='FakeAtomServer')
+        thread.daemon = True
+        thread.start()
+        return self
+
+class FakeJMAPAccount(object):
+    """A JMAP account's mailboxes as [id, name, parentId, role, unread], its
+    Mailbox state, and the EventSource connections to tell about changes."""
+    def __init__(self, unseen=10):
+        self.state = 1
+        self.mailboxes = [['m1', 'Inbox', None, 'inbox', unseen],
+                          ['m2', 'Work', None, None, 0],
+                          ['m3', 'Lists', None, None, 0],
+                          ['m4', 'foo', 'm3', None, 0]]
+        self.listeners = []     # Queue.Queue of each EventSource
+
+class FakeJMAPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        if self.server.certfile:
+            self.request = ssl.wrap_socket(self.request, server_side=True,
+                                           certfile=self.server.certfile)
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def _user(self):
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        return base64.b64decode(auth[6:]).split(':', 1)[0]
+
+    def _reply(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if self.path == '/.well-known/jmap':
+            # As many servers do, point elsewhere for the session
+            self.send_response(307)
+            self.send_header('Location', '/jmap/session')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        user = self._user()
+        if user is None:
+            return
+        if self.path == '/jmap/session':
+            # With URLs relative to the session's own
+            self._reply({
+                'capabilities': {CORE: {}, MAIL: {}},
+                'accounts': {user: {'name': user, 'isPersonal': True,
+                                    'accountCapabilities': {MAIL: {}}}},
+                'primaryAccounts': {MAIL: user}, 'username': user,
+                'apiUrl': 'api/', 'uploadUrl': 'upload/',
+                'downloadUrl': 'download/',
+                'eventSourceUrl': 'eventsource/?types={types}'
+                '&closeafter={closeafter}&ping={ping}',
+                'state': '1'})
+        elif self.path.startswith('/jmap/eventsource/'):
+            self._event_source(user)
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+        server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        user = self._user()
+        request = json.loads(self.rfile.read(
+            int(self.headers.get('Content-Length', 0))))
+        if user is None:
+            return
+        responses = []
+        for name, args, tag in request['methodCalls']:
+            if name != 'Mailbox/get' or args.get('accountId') != user:
+                responses.append(['error', {'type': 'unknownMethod'
+                                            if name != 'Mailbox/get'
+                                            else 'accountNotFound'}, tag])
+                continue
+            with server.lock:
+                account = server.account(user)
+                mailboxes = [{'id': id, 'name': name, 'parentId': parent,
+                              'role': role, 'unreadEmails': unread}
+                             for id, name, parent, role, unread
+                             in account.mailboxes]
+                state = str(account.state)
+            responses.append(['Mailbox/get', {'accountId': user,
+                                              'state': state,
+                                              'list': mailboxes,
+                                              'notFound': []}, tag])
+        self._reply({'methodResponses': responses, 'sessionState': '1'})
+
+    def _event_source(self, user):
+        # Chunked, as most servers send it; pings every ping seconds
+        query = dict(x.partition('=')[::2]
+                     for x in self.path.partition('?')[2].split('&'))
+        ping = int(query.get('ping') or 0) or None
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.flush()
+        queue = Queue.Queue()
+        with self.server.lock:
+            self.server.account(user).listeners.append(queue)
+        try:
+            while True:
+                try:
+                    data = queue.get(timeout=ping)
+                except Queue.Empty:
+                    data = 'event: ping\ndata: %s\n\n' % (
+                        json.dumps({'interval': ping}),)
+                self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+        except socket.error:
+            pass    # The client went away
+        finally:
+            with self.server.lock:
+                self.server.account(user).listeners.remove(queue)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeJMAPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A JMAP server on localhost answering Mailbox/get, with an EventSource
+    push channel telling each user's clients when their mailboxes change."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, certfile=None, latency=0, unseen=10):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0),
+                                           FakeJMAPHandler)
+        self.certfile = certfile
+        self.latency = latency
+        self.unseen = unseen
+        self.lock = threading.Lock()
+        self.accounts = {}      # User -> FakeJMAPAccount
+        self.requests = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def listeners(self):
+        with self.lock:
+            return sum(len(account.listeners)
+                       for account in self.accounts.values())
+
+    def handle_error(self, request, client_address):
+        # Clients going away, e.g. when a benchmark ends, is expected
+        if not isinstance(sys.exc_info()[1], socket.error):
+            SocketServer.BaseServer.handle_error(self, request, client_address)
+
+    def account(self, user):
+        # Call with the lock held
+        if user not in self.accounts:
+            self.accounts[user] = FakeJMAPAccount(self.unseen)
+        return self.accounts[user]
+
+    def deliver(self, user):
+        # A new unread message in the inbox, changing the Mailbox state
+        with self.lock:
+            account = self.account(user)
+            account.mailboxes[0][4] += 1
+            account.state += 1
+            data = 'event: state\ndata: %s\n\n' % (json.dumps({
+                '@type': 'StateChange',
+                'changed': {user: {'Mailbox': str(account.state)}}}),)
+            for queue in account.listeners:
+                queue.put(data)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='FakeJMAPServer')
+        thread.daemon = True
+        thread.start()
+        return self
+
+def main():
+    # Serve until stdin is closed, printing the ports as JSON first. Each
+    # "deliver" line delivers a new message to every mailbox, feed and JMAP
+    # account, and prints when that started; "stats" prints what the servers
+    # have seen.
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds to delay every reply")
+    parser.add_argument('--size', type=int, default=100,
+                        help="messages in each IMAP mailbox")
+    parser.add_argument('--unseen', type=int, default=10,
+                        help="unseen messages in each mailbox and feed")
+    parser.add_argument('--capabilities', default='IDLE',
+                        help="IMAP capabilities besides IMAP4rev1, e.g. "
+                        "'IDLE ESEARCH CONDSTORE'")
+    parser.add_argument('--stall', choices=STALL_PHASES,
+                        help="never answer IMAP clients in this phase")
+    args = parser.parse_args()
+    certfile = make_certificate()
+    imap = FakeIMAPServer(certfile, args.latency, args.size, args.unseen,
+                          args.capabilities.split(), args.stall).start()
+    atom = FakeAtomServer(certfile, args.latency, args.unseen).start()
+    jmap = FakeJMAPServer(certfile, args.latency, args.unseen).start()
+    print json.dumps({'imap': imap.port, 'atom': atom.port,
+                      'jmap': jmap.port, 'certfile': certfile})
+    sys.stdout.flush()
+    for line in iter(sys.stdin.readline, ''):
+        if line.strip() == 'deliver':
+            start = time.time()
+            with imap.lock:
+                mailboxes = imap.mailboxes.values()
+            for mailbox in mailboxes:
+                mailbox.deliver()
+            with atom.lock:
+                feeds = atom.feeds.keys()
+            for user, path in feeds:
+                atom.deliver(user, path)
+            with jmap.lock:
+                users = jmap.accounts.keys()
+            for user in users:
+                jmap.deliver(user)
+            print json.dumps({'delivered': start})
+        elif line.strip() == 'stats':
+            print json.dumps({'imap_commands': imap.commands,
+                              'imap_idling': imap.idlers,
+                              'atom_requests': atom.requests,
+                              'jmap_requests': jmap.requests,
+                              'jmap_listening': jmap.listeners})
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()